@@ -0,0 +1,309 @@
+import os
+import sys
+import time
+import copy
+import json
+import struct
+import threading
+import codec
+from framing import FrameReader, encode_frame, SIZEOF_INT
+from updates import UpdateStream
+from tracing import tracer
+from signals import SignalRegistry
+from pipe import SocketTransport, PIPE_BUSY, PIPE_NOT_FOUND
+from item_state import ItemState, Debouncer, PipeHandler, InventoryComparator, MAX_LATENCY
+from item_server import ItemServer, SAMPLE_ITEMS, ALL_LOCATIONS, swap_script
+from snapshot import SnapshotSource, SNAPSHOT_RETRIES, region_path
+
+
+def full_gear():
+    # Fill every body location by cycling through the sample items.
+    items = []
+    for i, location in enumerate(ALL_LOCATIONS):
+        item = copy.deepcopy(SAMPLE_ITEMS[i % len(SAMPLE_ITEMS)])
+        item[u'Location'] = location
+        items.append(item)
+    return items
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def timed(fn, number):
+    start = time.time()
+    for _ in xrange(number):
+        fn()
+    return (time.time() - start) / number
+
+
+def update_samples():
+    items = full_gear()
+    state = ItemState(None)
+    state.diff(items)
+    snapshot = state.snapshot()
+
+    swapped = list(items)
+    swapped[0] = dict(swapped[0], ItemName=u'Peasant Crown')
+    diff = state.diff(swapped)
+
+    stream = UpdateStream(True)
+    keyframe = stream.next(snapshot)
+    delta = stream.next(state.snapshot(), diff)
+
+    # With a string table the delta only names strings the keyframe lacked.
+    stream = UpdateStream(True, strings=True)
+    keyframe_strings = stream.next(snapshot)
+    delta_strings = stream.next(state.snapshot(), diff)
+    return [
+        ('snapshot', UpdateStream(False).next(snapshot)),
+        ('keyframe', keyframe),
+        ('delta', delta),
+        ('keyframe+strings', keyframe_strings),
+        ('delta+strings', delta_strings)
+    ]
+
+
+def bench_encoding(number=2000):
+    names = [codec.LEGACY] + list(reversed(codec.supported()))
+    print 'Encoding (bytes, microseconds per message)'
+    for label, update in update_samples():
+        print '  %s' % label
+        for name in names:
+            encoder = codec.Codec(name)
+            size = len(encoder.encode(update))
+            elapsed = timed(lambda: encoder.encode(update), number)
+            print '    %-16s %6d B %8.1f us' % (name, size, elapsed * 1e6)
+    if codec.msgpack is None:
+        print '  (msgpack not installed, binary encodings skipped)'
+
+
+def bench_diff(number=20000):
+    # Steady state: the pipe keeps returning equal (but freshly parsed) items.
+    items = full_gear()
+    debouncer = Debouncer(None, lambda snapshot, diff: None)
+    debouncer.feed(copy.deepcopy(items))
+    debouncer.flush()
+    polls = [copy.deepcopy(items) for _ in xrange(16)]
+    state = {'i': 0}
+
+    def poll():
+        state['i'] += 1
+        debouncer.feed(polls[state['i'] % len(polls)])
+
+    elapsed = timed(poll, number)
+    print 'Diff (unchanged 12 slot gear set)'
+    print '  %8.1f us per poll' % (elapsed * 1e6)
+
+
+class _BufferTransport:
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def rewind(self):
+        self.pos = 0
+
+    def read(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def readinto(self, view):
+        chunk = self.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def _legacy_read(transport):
+    # The pre-framing PipeHandler._transact loop, for comparison.
+    out = transport.read(1024)
+    length = struct.unpack('i', out[:SIZEOF_INT])[0]
+    while len(out) < length + SIZEOF_INT:
+        out += transport.read(1024)
+    return out[SIZEOF_INT:]
+
+
+def bench_framing(number=2000):
+    print 'Framing (read one response into a parseable string; parse shown for scale)'
+    gear = full_gear()
+    for count in (1, 12, 48, 192):
+        items = [gear[i % len(gear)] for i in xrange(count)]
+        payload = json.dumps({u'IsValid': True, u'Success': True, u'Items': items})
+        transport = _BufferTransport(encode_frame(payload))
+        reader = FrameReader(transport)
+
+        def legacy():
+            transport.rewind()
+            _legacy_read(transport)
+
+        def framed():
+            transport.rewind()
+            reader.read_frame().tobytes()
+
+        print '  %7d B  legacy %8.1f us  framed %8.1f us  parse %8.1f us' % (
+            len(payload),
+            timed(legacy, number) * 1e6,
+            timed(framed, number) * 1e6,
+            timed(lambda: json.loads(payload, encoding='utf-8'), number) * 1e6
+        )
+
+
+def bench_pipeline(seconds=3.0, swaps=10, interval=1.0, latency=0.0005):
+    items = full_gear()
+    server = ItemServer(('127.0.0.1', 0), items, latency=latency).start()
+    registry = SignalRegistry()
+
+    # Throughput: back to back generation check + full read + diff.
+    pipe = PipeHandler(registry, SocketTransport(server.address))
+    debouncer = Debouncer(registry, lambda snapshot, diff: None)
+    tracer.start(os.devnull)
+    polls = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        with tracer.span('poll'):
+            pipe.get_generation()
+            debouncer.feed(pipe.get_items())
+        polls += 1
+    tracer.stop()
+    debouncer.cancel()
+    pipe.close()
+
+    print 'Pipeline (stand-in latency %.1f ms)' % (latency * 1000)
+    print '  %.0f polls/sec' % (polls / seconds)
+    print '  %-16s %9s %9s %9s' % ('stage', 'p50 ms', 'p90 ms', 'p99 ms')
+    for name in sorted(tracer.stats):
+        stats = tracer.stats[name]
+        print '  %-16s %9.3f %9.3f %9.3f' % (
+            name, stats.percentile(50) * 1000,
+            stats.percentile(90) * 1000, stats.percentile(99) * 1000
+        )
+
+    # Change-to-send: the real comparator loop against scripted swaps.
+    sends = []
+    stream = UpdateStream()
+    encoder = codec.Codec('json')
+
+    def send(snapshot, diff, channel=None):
+        encoder.encode(stream.next(snapshot, diff))
+        sends.append(time.time())
+
+    registry.register('update', send)
+    comparator = InventoryComparator(registry, SocketTransport(server.address))
+    comparator.connect()
+    time.sleep(MAX_LATENCY)
+    del server.changes[:]
+    server.run_script(swap_script(items, swaps, interval, seed=1))
+    time.sleep(MAX_LATENCY)
+    comparator.disconnect()
+    server.stop()
+
+    latencies = []
+    for change in server.changes:
+        after = [sent for sent in sends if sent >= change]
+        if after:
+            latencies.append(after[0] - change)
+    print '  change-to-send over %d swaps: p50 %.0f ms, p90 %.0f ms, max %.0f ms' % (
+        len(latencies), percentile(latencies, 50) * 1000,
+        percentile(latencies, 90) * 1000, max(latencies or [0]) * 1000
+    )
+    bench_pipe_errors(items, latency)
+
+
+def bench_pipe_errors(items, latency, hold=0.2, outage=0.5):
+    # The two ways DiabloInterface turns a client away: another client
+    # holding its one pipe instance (busy), and not running (not found).
+    server = ItemServer(('127.0.0.1', 0), items, latency=latency, single_client=True).start()
+    registry = SignalRegistry()
+    holder = PipeHandler(registry, SocketTransport(server.address))
+    holder.get_generation()
+    threading.Timer(hold, holder.close).start()
+    pipe = PipeHandler(registry, SocketTransport(server.address))
+    busy = PIPE_BUSY.value
+    started = time.time()
+    pipe.get_generation()
+    print '  busy pipe held for %.0f ms: %d busy retries, served after %.0f ms' % (
+        hold * 1000, PIPE_BUSY.value - busy, (time.time() - started) * 1000
+    )
+
+    not_found = PIPE_NOT_FOUND.value
+    server.outage(outage, refuse=True)
+    started = time.time()
+    pipe.get_generation()
+    print '  pipe gone for %.0f ms: %d not found retries, served after %.0f ms' % (
+        outage * 1000, PIPE_NOT_FOUND.value - not_found, (time.time() - started) * 1000
+    )
+    pipe.close()
+    server.stop()
+
+
+def bench_snapshot(number=2000, latency=0.0005, seconds=2.0):
+    items = full_gear()
+    name = 'd2id-bench-%d' % os.getpid()
+    server = ItemServer(('127.0.0.1', 0), items, latency=latency, snapshots=name).start()
+    registry = SignalRegistry()
+    pipe = PipeHandler(registry, SocketTransport(server.address))
+    snapshots = SnapshotSource(registry, name, PipeHandler(registry, SocketTransport(server.address)))
+    snapshots.get_generation()
+    assert snapshots.active, 'shared memory snapshots not picked up'
+
+    print 'Item source (stand-in latency %.1f ms; microseconds per call)' % (latency * 1000)
+    print '  %-16s %10s %10s' % ('', 'pipe', 'snapshot')
+    for label, call in (('get_generation', lambda source: source.get_generation()),
+                        ('get_items', lambda source: source.get_items())):
+        print '  %-16s %10.1f %10.1f' % (
+            label, timed(lambda: call(pipe), number) * 1e6,
+            timed(lambda: call(snapshots), number) * 1e6
+        )
+
+    # Reads racing a writer that republishes every millisecond, a hundred
+    # times DiabloInterface's rate.
+    stop = threading.Event()
+
+    def churn():
+        while not stop.wait(0.001):
+            server.equip(dict(items[0], ItemName=u'Peasant Crown %d' % server.generation))
+
+    writer = threading.Thread(target=churn)
+    writer.daemon = True
+    writer.start()
+    retries = SNAPSHOT_RETRIES.value
+    reads = 0
+    torn = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        generation, payload = snapshots.reader.read()
+        if json.loads(payload)[u'Generation'] != generation:
+            torn += 1
+        reads += 1
+    stop.set()
+    writer.join()
+    print '  against a 1 kHz writer: %.0f reads/sec, %.3f retries per read, %d torn' % (
+        reads / seconds, float(SNAPSHOT_RETRIES.value - retries) / max(1, reads), torn
+    )
+
+    pipe.close()
+    snapshots.close()
+    server.stop()
+    if sys.platform != 'win32':
+        os.remove(region_path(name))
+
+
+BENCHMARKS = [
+    ('encoding', bench_encoding),
+    ('diff', bench_diff),
+    ('framing', bench_framing),
+    ('pipeline', bench_pipeline),
+    ('snapshot', bench_snapshot)
+]
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for name, bench in BENCHMARKS:
+        if not selected or name in selected:
+            bench()
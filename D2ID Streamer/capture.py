@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import struct
+from bisect import bisect_right
+from threading import Lock
+
+MAGIC = 'D2IDCAP1'
+FLAG_DEFLATE = 0x01
+FILE_HEADER = struct.Struct('<8sB')
+# Wall clock timestamp and payload length of one get_items result.
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter:
+
+    def __init__(self, path, compress=True):
+        self.path = path
+        self.lock = Lock()
+        self.records = 0
+        self.compress = compress
+        if os.path.exists(path) and os.path.getsize(path):
+            # Appending to an existing capture keeps its encoding, and starts
+            # after its last whole record: a record cut short by a crash is
+            # cut off rather than run into the next one.
+            reader = CaptureReader(path)
+            self.compress = reader.compress
+            end = reader.end
+            reader.close()
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, FLAG_DEFLATE if compress else 0))
+            self.file.flush()
+
+    def record(self, items, ts=None):
+        if ts is None:
+            ts = time.time()
+        payload = json.dumps(items, separators=(',', ':'))
+        if self.compress:
+            payload = zlib.compress(payload)
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(ts, len(payload)) + payload)
+            self.file.flush()
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _read_header(data):
+    if len(data) < FILE_HEADER.size:
+        raise CaptureError('not a capture file')
+    magic, flags = FILE_HEADER.unpack(data)
+    if magic != MAGIC:
+        raise CaptureError('not a capture file')
+    return flags
+
+
+class CaptureReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.compress = bool(_read_header(self.data[:FILE_HEADER.size]) & FLAG_DEFLATE)
+        self.timestamps = []
+        self.offsets = []
+        self.end = FILE_HEADER.size
+        self._index()
+
+    def _index(self):
+        # Only the record headers are touched; payloads are decoded on access.
+        # A record cut short by a crash while recording is ignored.
+        offset = FILE_HEADER.size
+        end = len(self.data)
+        while offset + RECORD_HEADER.size <= end:
+            ts, length = RECORD_HEADER.unpack_from(self.data, offset)
+            if offset + RECORD_HEADER.size + length > end:
+                break
+            self.timestamps.append(ts)
+            self.offsets.append(offset)
+            offset += RECORD_HEADER.size + length
+        self.end = offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        offset = self.offsets[index]
+        ts, length = RECORD_HEADER.unpack_from(self.data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = self.data[start:start + length]
+        try:
+            if self.compress:
+                payload = zlib.decompress(payload)
+            return ts, json.loads(payload, encoding='utf-8')
+        except (zlib.error, ValueError) as e:
+            raise CaptureError('record %d is damaged: %s' % (index, e))
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def index_at(self, ts):
+        # Index of the last record taken at or before ts.
+        return max(0, bisect_right(self.timestamps, ts) - 1)
+
+    def duration(self):
+        if not self.timestamps:
+            return 0.0
+        return self.timestamps[-1] - self.timestamps[0]
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class ReplaySource:
+
+    # Stands in for PipeHandler: serves the captured item sets in order,
+    # spaced out as they were recorded (divided by speed).
+
+    def __init__(self, reader, speed=1.0, start=0):
+        self.reader = reader
+        self.speed = speed
+        self.position = start
+        self.started = None
+        self.items = None
+
+    def finished(self):
+        return self.position >= len(self.reader)
+
+    def get_generation(self):
+        # Holds still once the capture runs out, so the comparator stops
+        # reading until its periodic refresh.
+        return self.position
+
+    def get_items(self, slots=None):
+        while not self.finished():
+            try:
+                ts, items = self.reader[self.position]
+            except CaptureError:
+                # Skipped, or every later poll would fail on it again.
+                self.position += 1
+                continue
+            now = time.time()
+            if self.started is None:
+                self.started = (now, ts)
+            else:
+                due = self.started[0] + (ts - self.started[1]) / self.speed
+                if due > now:
+                    time.sleep(due - now)
+            self.position += 1
+            self.items = items
+            return items
+        if self.items is None:
+            raise CaptureError('no readable records left to replay')
+        return self.items
+
+    def close(self):
+        pass
+
+
+def replay(path, speed=1.0):
+    from signals import SignalRegistry
+    from item_state import (
+        InventoryComparator, POLL_INTERVAL, FAST_POLL_INTERVAL,
+        MAX_POLL_INTERVAL, IDLE_AFTER, QUIET_PERIOD, MAX_LATENCY
+    )
+
+    reader = CaptureReader(path)
+    source = ReplaySource(reader, speed)
+    registry = SignalRegistry()
+    updates = []
+
+    def on_update(snapshot, diff, channel=None):
+        updates.append(diff.length())
+        print '%8.3f  +%d -%d' % (
+            time.time() - source.started[0], len(diff.added), len(diff.removed)
+        )
+
+    registry.register('update', on_update)
+    # Every interval in the loop is scaled along with the capture, so an
+    # accelerated replay debounces the same way the session did.
+    comparator = InventoryComparator(
+        registry, source=source, capture=None,
+        poll_interval=POLL_INTERVAL / speed,
+        polling={
+            'fast_interval': FAST_POLL_INTERVAL / speed,
+            'max_interval': MAX_POLL_INTERVAL / speed,
+            'idle_after': IDLE_AFTER / speed
+        },
+        debounce={
+            'quiet_period': QUIET_PERIOD / speed,
+            'max_latency': MAX_LATENCY / speed
+        }
+    )
+    start = time.time()
+    comparator.connect()
+    while not source.finished():
+        time.sleep(0.1)
+    # Let the debouncer publish whatever the last records changed.
+    time.sleep(1.0)
+    comparator.disconnect()
+    comparator.loop.join()
+    print '%d records (%.1f s captured) replayed in %.1f s, %d updates' % (
+        len(reader), reader.duration(), time.time() - start, len(updates)
+    )
+    reader.close()
+
+
+def info(path):
+    reader = CaptureReader(path)
+    print '%s: %d records over %.1f s, %d bytes%s' % (
+        path, len(reader), reader.duration(), os.path.getsize(path),
+        ' (deflate)' if reader.compress else ''
+    )
+    reader.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('info', 'replay'):
+        print 'usage: capture.py info <file> | replay <file> [speed]'
+        sys.exit(1)
+    if sys.argv[1] == 'info':
+        info(sys.argv[2])
+    else:
+        replay(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
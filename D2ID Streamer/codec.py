@@ -0,0 +1,73 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+LEGACY = 'legacy'
+DEFLATE_SUFFIX = '+deflate'
+
+# Most preferred first; the EBS picks one of these during the handshake.
+PREFERENCE = ['msgpack+deflate', 'json+deflate', 'msgpack', 'json']
+
+
+def _legacy(update):
+    # What every EBS understands: a JSON string literal holding the JSON.
+    return json.dumps(json.dumps(update))
+
+
+def _json(update):
+    return json.dumps(update, separators=(',', ':'))
+
+
+def _msgpack(update):
+    return msgpack.packb(update, use_bin_type=True)
+
+
+def _deflate(data):
+    # Raw deflate stream, compressed independently for every message.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+SERIALIZERS = {
+    LEGACY:    (_legacy, False),
+    'json':    (_json, False),
+    'msgpack': (_msgpack, True)
+}
+
+
+class Codec:
+
+    def __init__(self, name):
+        base = name
+        self.deflate = name.endswith(DEFLATE_SUFFIX)
+        if self.deflate:
+            base = name[:-len(DEFLATE_SUFFIX)]
+        self.name = name
+        self.serialize, self.binary = SERIALIZERS[base]
+        self.binary = self.binary or self.deflate
+
+    def encode(self, update):
+        data = self.serialize(update)
+        if self.deflate:
+            data = _deflate(data)
+        return data
+
+
+def supported():
+    names = PREFERENCE
+    if msgpack is None:
+        names = [name for name in names if not name.startswith('msgpack')]
+    return names
+
+
+def negotiate(selected):
+    # An EBS that does not answer the offer only understands the legacy form.
+    if selected:
+        selected = selected.strip().lower()
+        if selected in supported():
+            return Codec(selected)
+    return Codec(LEGACY)
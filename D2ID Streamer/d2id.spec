@@ -48,3 +48,38 @@ exe = EXE(
     runtime_tmpdir=None,
     console=False
 )
+
+# Console build for unattended streaming boxes; no Tk or pygubu inside.
+headless = Analysis(
+    ['headless.py'],
+    pathex=['C:\\Python27\\Lib\\site-packages\\'],
+    binaries=[],
+    datas=[],
+    hiddenimports=[],
+    hookspath=[],
+    runtime_hooks=[],
+    excludes=['Tkinter', 'FixTk', 'tcl', 'tk', 'pygubu'],
+    win_no_prefer_redirects=False,
+    win_private_assemblies=False,
+    cipher=block_cipher
+)
+
+headless_pyz = PYZ(
+    headless.pure,
+    headless.zipped_data,
+    cipher=block_cipher
+)
+
+headless_exe = EXE(
+    headless_pyz,
+    headless.scripts,
+    headless.binaries,
+    headless.zipfiles,
+    headless.datas,
+    name='d2id-headless',
+    debug=False,
+    strip=False,
+    upx=True,
+    runtime_tmpdir=None,
+    console=True
+)
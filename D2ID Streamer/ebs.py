@@ -1,24 +1,317 @@
-from threading import Thread, Event
-from websocket import WebSocketApp
+from threading import Thread, Event, Condition, Lock
+from collections import deque
+from websocket import WebSocketApp, ABNF, create_connection, WebSocketTimeoutException
+from updates import UpdateStream
+from tracing import tracer
+from metrics import metrics
 import traceback
 import logging
+import random
+import time
+import codec
 
 CLIENT_VERSION = '0.1.4'
 
 BASE_URL = 'wss://d2id.multilurk.tv'
 UPDATE = '/update'
 
+SEND_QUEUE_SIZE = 8
+PING_INTERVAL = 120.0
+PING_TIMEOUT = 10.0
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_STABLE_AFTER = 30.0
+
+UPDATES_SENT = metrics.counter('d2id_updates_sent_total', 'Update messages sent to the EBS.')
+BYTES_SENT = metrics.counter('d2id_update_bytes_sent_total', 'Encoded update bytes sent to the EBS.')
+SEND_ERRORS = metrics.counter('d2id_send_errors_total', 'Update sends that failed.')
+RECONNECTS = metrics.counter('d2id_ebs_reconnects_total', 'Scheduled EBS reconnects.')
+SEND_QUEUE_DROPPED = metrics.counter(
+    'd2id_send_queue_dropped_total', 'Updates folded into a later snapshot by a full send queue.'
+)
+CHANGE_TO_SEND = metrics.histogram(
+    'd2id_change_to_send_seconds', 'From reading an item change off the pipe to sending it.'
+)
+
 logging.basicConfig()
 sslopt_ca_certs = {'ca_certs': './cacert.pem'}
 
 
+class SendQueue:
+
+    def __init__(self, send, maxsize=SEND_QUEUE_SIZE, runtime=None):
+        self.send = send
+        self.maxsize = maxsize
+        self.pending = deque()
+        self.cond = Condition()
+        self.open = False
+        self.running = True
+        self.dropped = 0
+
+        # On an event loop the queue is drained by a loop callback instead
+        # of a sender thread.
+        self.runtime = runtime
+        self.scheduled = False
+        self.thread = None
+        if runtime is None:
+            self.thread = Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _notify(self):
+        if self.runtime is None:
+            self.cond.notify()
+        elif not self.scheduled:
+            self.scheduled = True
+            self.runtime.call_soon_threadsafe(self._drain)
+
+    def put(self, snapshot, diff, channel=None):
+        with self.cond:
+            if len(self.pending) >= self.maxsize:
+                # Only the latest state matters, so a full backlog collapses
+                # into one full snapshot per channel.
+                latest = {}
+                for queued in self.pending:
+                    latest[queued[0]] = queued[1]
+                latest[channel] = snapshot
+                dropped = len(self.pending) + 1 - len(latest)
+                self.dropped += dropped
+                SEND_QUEUE_DROPPED.inc(dropped)
+                self.pending.clear()
+                for queued_channel, queued_snapshot in latest.items():
+                    self.pending.append((queued_channel, queued_snapshot, None))
+            else:
+                self.pending.append((channel, snapshot, diff))
+            self._notify()
+
+    def resume(self, snapshots=None):
+        # Anything queued was meant for the old connection; start the new
+        # one from the latest full state of every channel instead.
+        with self.cond:
+            self.pending.clear()
+            for channel, snapshot in (snapshots or {}).items():
+                self.pending.append((channel, snapshot, None))
+            self.open = True
+            self._notify()
+
+    def pause(self):
+        with self.cond:
+            self.open = False
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self._notify()
+
+    def _deliver(self, channel, snapshot, diff):
+        try:
+            self.send(channel, snapshot, diff)
+            return True
+        except Exception:
+            # The socket went away mid-send. Hold off until the next
+            # resume(), which replays the latest state.
+            SEND_ERRORS.inc()
+            traceback.print_exc()
+            self.pause()
+            return False
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not (self.open and self.pending):
+                    self.cond.wait()
+                if not self.running:
+                    return
+                channel, snapshot, diff = self.pending.popleft()
+            self._deliver(channel, snapshot, diff)
+
+    def _drain(self):
+        while True:
+            with self.cond:
+                self.scheduled = False
+                if not (self.running and self.open and self.pending):
+                    return
+                channel, snapshot, diff = self.pending.popleft()
+            if not self._deliver(channel, snapshot, diff):
+                return
+
+
+class Backoff:
+
+    def __init__(self, base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        # Exponential with "equal jitter": at least half the nominal delay,
+        # so a fleet of clients dropped together does not reconnect together.
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class LoopWebSocketApp:
+
+    # WebSocketApp's callback interface on a runtime.EventLoop: the socket
+    # is read when select() says so and pings are loop timers, instead of a
+    # thread blocked in run_forever(). Only the handshake blocks the loop.
+
+    def __init__(self, runtime, url, header, on_open, on_close, on_message,
+                 on_error, on_pong):
+        self.runtime = runtime
+        self.url = url
+        self.header = header
+        self.on_open = on_open
+        self.on_close = on_close
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_pong = on_pong
+
+        self.sock = None
+        # The socket registered with the loop; websocket-client drops its
+        # own reference (sock.sock) when the peer closes the connection.
+        self.raw = None
+        self.keep_running = False
+        self.closed = False
+        self.pinger = None
+        self.last_ping = 0
+        self.last_pong = 0
+
+    def _callback(self, callback, *args):
+        try:
+            callback(self, *args)
+        except Exception:
+            traceback.print_exc()
+
+    def run_forever(self, ping_interval, ping_timeout, sslopt, on_exit):
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.on_exit = on_exit
+        try:
+            self.sock = create_connection(
+                self.url, header=self.header, sslopt=sslopt, timeout=ping_timeout
+            )
+        except Exception as e:
+            self._teardown(e)
+            return
+        self.keep_running = True
+        self.raw = self.sock.sock
+        self.runtime.add_reader(self.raw, self._on_readable)
+        self._callback(self.on_open)
+        if ping_interval:
+            self.pinger = self.runtime.call_later(ping_interval, self._ping)
+
+    def _ping(self):
+        if not self.keep_running:
+            return
+        self.last_ping = time.time()
+        try:
+            self.sock.ping()
+        except Exception as e:
+            self._teardown(e)
+            return
+        self.pinger = self.runtime.call_later(self.ping_timeout, self._check_pong)
+
+    def _check_pong(self):
+        if not self.keep_running:
+            return
+        if self.last_pong < self.last_ping:
+            self._teardown(WebSocketTimeoutException('ping/pong timed out'))
+            return
+        self.pinger = self.runtime.call_later(
+            self.ping_interval - self.ping_timeout, self._ping
+        )
+
+    def _on_readable(self):
+        try:
+            while self.keep_running:
+                op_code, frame = self.sock.recv_data_frame(True)
+                if op_code == ABNF.OPCODE_CLOSE:
+                    self._teardown()
+                    return
+                elif op_code == ABNF.OPCODE_PONG:
+                    self.last_pong = time.time()
+                    self._callback(self.on_pong, frame.data)
+                elif op_code in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                    self._callback(self.on_message, frame.data)
+                # TLS may already hold decrypted frames select() cannot see.
+                pending = getattr(self.sock.sock, 'pending', None)
+                if pending is None or not pending():
+                    return
+        except Exception as e:
+            self._teardown(e)
+
+    def send(self, data, opcode=ABNF.OPCODE_TEXT):
+        self.sock.send(data, opcode)
+
+    def close(self):
+        if self.runtime.in_loop():
+            self._teardown()
+        else:
+            self.runtime.call_soon_threadsafe(self._teardown)
+
+    def _teardown(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.keep_running = False
+        if self.pinger is not None:
+            self.pinger.cancel()
+        if self.raw is not None:
+            self.runtime.remove_reader(self.raw)
+            self.raw = None
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+        if error is not None:
+            self._callback(self.on_error, error)
+        self._callback(self.on_close)
+        self.on_exit()
+
+
 class EBSConnection():
 
-    def __init__(self, registry):
+    def __init__(self, registry, delta_updates=False, channels=None, runtime=None,
+                 string_tables=True, url=None):
         self.registry = registry
+        self.url = url or BASE_URL + UPDATE
+        # With a runtime.EventLoop the websocket, pings, reconnects and
+        # sends all run on that loop instead of threads of their own.
+        self.runtime = runtime
+
+        self.ping_interval      = PING_INTERVAL
+        self.ping_timeout       = PING_TIMEOUT
 
-        self.ping_interval      = 120.0
-        self.ping_timeout       = 10.0
+        # Every item source gets its own stream and latest snapshot, keyed
+        # by channel; None is the single source of a one character client.
+        self.delta_updates = delta_updates
+        # Offered with delta updates; used once the EBS confirms it.
+        self.string_tables = string_tables
+        self.strings = False
+        self.channels  = channels
+        self.streams   = {}
+        self.snapshots = {}
+        # Streams are reset from the websocket side (on_open, resync) while
+        # the sender encodes from them; every access takes this lock, so a
+        # message's string ids and strings_base come from the same table.
+        self.stream_lock = Lock()
+        self.codec     = codec.negotiate(None)
+        self.queue     = SendQueue(self._send_update, runtime=runtime)
+
+        self.backoff        = Backoff()
+        self.stopped        = Event()
+        self.authenticated  = False
+        self.logged_in_at   = 0
+        self.ws             = None
+        self.sock           = None
+        self.retry          = None
 
         self.registry.register('ebs connect', self.connect)
         self.registry.register('ebs disconnect', self.disconnect)
@@ -26,6 +319,14 @@ class EBSConnection():
 
     def connect(self, username, password):
         def on_open(ws):
+            headers = ws.sock.getheaders() or {}
+            self.codec = codec.negotiate(headers.get('x-update-encoding'))
+            self.strings = self.delta_updates and self.string_tables and \
+                headers.get('x-update-strings', '').strip().lower() == 'table'
+            with self.stream_lock:
+                for stream in self.streams.values():
+                    stream.reset()
+                    stream.strings = self.strings
             self.registry.emit('ebs connected')
             self.registry.emit('log', 'Connection to EBS established.')
 
@@ -34,51 +335,177 @@ class EBSConnection():
             traceback.print_exc()
 
         def on_close(ws):
+            self.queue.pause()
             self.registry.emit('log', 'Connection to EBS lost.')
 
         def on_msg(ws, msg):
             self.registry.emit('log', 'EBS > ' + msg)
             if msg.encode('utf-8') == u'SUCCESS':
+                self.authenticated = True
+                self.logged_in_at = time.time()
+                self.queue.resume(self.snapshots)
                 self.registry.emit('logged in')
+            elif msg.encode('utf-8').split(' ')[0] == u'RESYNC':
+                # "RESYNC <channel>" for one source, bare RESYNC for all.
+                channel = msg.split(' ', 1)[1] if ' ' in msg else None
+                self.resync(channel)
 
         def on_pong(ws, data):
             self.registry.emit('log', 'PONG!')
 
-        def ws_main_loop(username, password):
-            ws = WebSocketApp(
-                BASE_URL + UPDATE,
-                header = [
-                    'X-User: ' + username,
-                    'X-Pass: ' + password,
-                    'X-Client-Version: ' + CLIENT_VERSION
-                ],
+        header = [
+            'X-User: ' + username,
+            'X-Pass: ' + password,
+            'X-Client-Version: ' + CLIENT_VERSION
+        ]
+        if self.delta_updates:
+            header.append('X-Update-Mode: delta')
+            if self.string_tables:
+                header.append('X-Update-Strings: table')
+        if self.channels:
+            header.append('X-Channels: ' + ', '.join(self.channels))
+        header.append('X-Accept-Update-Encoding: ' + ', '.join(codec.supported()))
+
+        def create_app(app_class):
+            self.ws = app_class(
+                self.url,
+                header     = header,
                 on_open    = on_open,
                 on_close   = on_close,
                 on_message = on_msg,
                 on_error   = on_error,
                 on_pong    = on_pong
             )
-            self.ws = ws
-            ws.run_forever(
+            return self.ws
+
+        def retry_delay():
+            # Only retry with credentials the EBS has accepted before;
+            # a rejected login should still drop back to the form.
+            if self.stopped.is_set() or not self.authenticated:
+                return None
+            # A connection that dropped soon after login keeps backing off.
+            if time.time() - self.logged_in_at > RECONNECT_STABLE_AFTER:
+                self.backoff.reset()
+            delay = self.backoff.next()
+            RECONNECTS.inc()
+            self.registry.emit('ebs reconnecting', delay)
+            self.registry.emit(
+                'log', 'Reconnecting to EBS in %.1f seconds...' % delay
+            )
+            return delay
+
+        def ws_main_loop():
+            while not self.stopped.is_set():
+                create_app(WebSocketApp).run_forever(
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_timeout,
+                    sslopt=sslopt_ca_certs
+                )
+                delay = retry_delay()
+                if delay is None:
+                    break
+                self.stopped.wait(delay)
+            self.registry.emit('ws thread return')
+
+        def loop_app(*args, **kwargs):
+            return LoopWebSocketApp(self.runtime, *args, **kwargs)
+
+        def loop_open():
+            self.retry = None
+            if self.stopped.is_set():
+                self.registry.emit('ws thread return')
+                return
+            create_app(loop_app).run_forever(
                 ping_interval=self.ping_interval,
                 ping_timeout=self.ping_timeout,
-                sslopt=sslopt_ca_certs
+                sslopt=sslopt_ca_certs,
+                on_exit=loop_closed
             )
-            self.registry.emit('ws thread return')
 
-        self.sock = Thread(target=ws_main_loop, args=(username, password))
-        self.sock.daemon = True
-        self.sock.start()
+        def loop_closed():
+            delay = retry_delay()
+            if delay is None:
+                self.registry.emit('ws thread return')
+            else:
+                self.retry = self.runtime.call_later(delay, loop_open)
+
+        self.stopped.clear()
+        self.authenticated = False
+        self.backoff.reset()
+        if self.runtime is not None:
+            self.runtime.call_soon_threadsafe(loop_open)
+        else:
+            self.sock = Thread(target=ws_main_loop)
+            self.sock.daemon = True
+            self.sock.start()
         self.registry.emit('ebs connecting')
 
     def disconnect(self, message=None):
-        if self.ws.keep_running:
+        self.stopped.set()
+        self.queue.pause()
+        if self.runtime is not None:
+            self.runtime.call_soon_threadsafe(self._shutdown, message)
+            return
+        if self.ws is not None and self.ws.keep_running:
             self.ws.close()
-        if self.sock.is_alive():
+        if self.sock is not None and self.sock.is_alive():
             self.sock.join()
             self.registry.emit('ws thread join', message)
 
-    def send_update(self, update):
-        #print update
-        if self.sock.is_alive():
-            self.ws.send(update)
+    def _shutdown(self, message):
+        # Event loop side of disconnect(); closing an open socket ends in
+        # on_close and the 'ws thread return' signal like a dropped one.
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+            self.registry.emit('ws thread join', message)
+        elif self.ws is not None and self.ws.keep_running:
+            self.ws.close()
+
+    def _send(self, update):
+        with tracer.span('send.encode'):
+            data = self.codec.encode(update)
+        with tracer.span('send'):
+            if self.codec.binary:
+                self.ws.send(data, ABNF.OPCODE_BINARY)
+            else:
+                self.ws.send(data)
+        UPDATES_SENT.inc()
+        BYTES_SENT.inc(len(data))
+
+    def _stream(self, channel):
+        stream = self.streams.get(channel)
+        if stream is None:
+            stream = self.streams[channel] = UpdateStream(
+                self.delta_updates, strings=self.strings
+            )
+        return stream
+
+    def _send_update(self, channel, snapshot, diff):
+        with self.stream_lock:
+            update = self._stream(channel).next(snapshot, diff)
+            if channel is not None:
+                # Multiplexed updates name their source after the body.
+                update += (channel,)
+            self._send(update)
+        if diff is not None and diff.detected is not None:
+            CHANGE_TO_SEND.time(diff.detected)
+
+    def send_update(self, snapshot, diff=None, channel=None):
+        # Called from the item reading side; never blocks on the socket.
+        self.snapshots[channel] = snapshot
+        self.queue.put(snapshot, diff, channel)
+
+    def resync(self, channel=None):
+        # The EBS lost track of our sequence; start over from a keyframe.
+        if channel is None:
+            with self.stream_lock:
+                for stream in self.streams.values():
+                    stream.request_keyframe()
+            self.queue.resume(self.snapshots)
+        else:
+            # The other channels are still in sync; leave their queue alone.
+            with self.stream_lock:
+                self._stream(channel).request_keyframe()
+            if channel in self.snapshots:
+                self.queue.put(self.snapshots[channel], None, channel)
@@ -0,0 +1,339 @@
+import json
+import time
+import zlib
+import base64
+import socket
+import struct
+import hashlib
+import argparse
+import threading
+import SocketServer
+import codec
+from metrics import Histogram
+
+DEFAULT_ADDRESS = ('127.0.0.1', 47401)
+UPDATE_PATH = '/update'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_CONT = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+def _read_exact(rfile, size):
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def read_frame(rfile):
+    # Returns (final, opcode, payload) of one frame, or None on hang up.
+    # Client frames are always masked.
+    header = _read_exact(rfile, 2)
+    if header is None:
+        return None
+    first, second = struct.unpack('!BB', header)
+    length = second & 0x7F
+    if length >= 126:
+        size = 2 if length == 126 else 8
+        extended = _read_exact(rfile, size)
+        if extended is None:
+            return None
+        length = struct.unpack('!H' if size == 2 else '!Q', extended)[0]
+    mask = None
+    if second & 0x80:
+        mask = _read_exact(rfile, 4)
+        if mask is None:
+            return None
+    payload = _read_exact(rfile, length) if length else ''
+    if payload is None:
+        return None
+    if mask:
+        key = bytearray(mask)
+        data = bytearray(payload)
+        for i in xrange(len(data)):
+            data[i] ^= key[i & 3]
+        payload = str(data)
+    return first & 0x80, first & 0x0F, payload
+
+
+def encode_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def decode_update(encoding, data):
+    if encoding.endswith(codec.DEFLATE_SUFFIX):
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+        encoding = encoding[:-len(codec.DEFLATE_SUFFIX)]
+    if encoding == codec.LEGACY:
+        return json.loads(json.loads(data))
+    if encoding == 'msgpack':
+        return codec.msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+
+class _Channel:
+
+    # What the EBS has to remember per item source to follow delta updates.
+
+    def __init__(self):
+        self.seq = None
+        self.strings = []
+        self.awaiting_keyframe = False
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def _handshake(self):
+        request = self.rfile.readline()
+        headers = {}
+        while True:
+            line = self.rfile.readline()
+            if not line or line in ('\r\n', '\n'):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if not request.startswith('GET ') or request.split()[1] != UPDATE_PATH or \
+                'sec-websocket-key' not in headers:
+            self.wfile.write('HTTP/1.1 400 Bad Request\r\n\r\n')
+            return None
+
+        accept = base64.b64encode(
+            hashlib.sha1(headers['sec-websocket-key'] + WEBSOCKET_GUID).digest()
+        )
+        response = [
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Accept: ' + accept
+        ]
+        encoding = self.server.owner.negotiate(headers.get('x-accept-update-encoding'))
+        if encoding != codec.LEGACY:
+            response.append('X-Update-Encoding: ' + encoding)
+        strings = headers.get('x-update-mode') == 'delta' and \
+            headers.get('x-update-strings') == 'table' and self.server.owner.string_tables
+        if strings:
+            response.append('X-Update-Strings: table')
+        self.wfile.write('\r\n'.join(response) + '\r\n\r\n')
+        self.wfile.flush()
+        return headers, encoding
+
+    def send(self, opcode, payload):
+        with self.write_lock:
+            self.request.sendall(encode_frame(opcode, payload))
+
+    def handle(self):
+        owner = self.server.owner
+        self.write_lock = threading.Lock()
+        negotiated = self._handshake()
+        if negotiated is None:
+            return
+        headers, encoding = negotiated
+        if not owner.authenticate(headers.get('x-user'), headers.get('x-pass')):
+            owner.count('rejected')
+            self.send(OPCODE_TEXT, 'FAILURE')
+            self.send(OPCODE_CLOSE, struct.pack('!H', 1008))
+            return
+
+        owner.attach(self, headers.get('x-client-version'))
+        self.channels = {}
+        try:
+            self.send(OPCODE_TEXT, 'SUCCESS')
+            fragments = []
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    return
+                final, opcode, payload = frame
+                if opcode == OPCODE_PING:
+                    self.send(OPCODE_PONG, payload)
+                elif opcode == OPCODE_CLOSE:
+                    self.send(OPCODE_CLOSE, payload[:2])
+                    return
+                elif opcode in (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONT):
+                    fragments.append(payload)
+                    if final:
+                        self.receive(encoding, ''.join(fragments))
+                        fragments = []
+        except socket.error:
+            pass
+        finally:
+            owner.detach(self)
+
+    def receive(self, encoding, data):
+        owner = self.server.owner
+        update = decode_update(encoding, data)
+        owner.received(len(data), time.time() - update[0])
+        body = update[1]
+        channel = update[2] if len(update) > 2 else None
+        if isinstance(body, dict) and u'seq' in body and not self.follow(channel, body):
+            owner.count('resyncs')
+            self.send(OPCODE_TEXT, 'RESYNC %s' % channel if channel is not None else 'RESYNC')
+
+    def follow(self, channel, body):
+        # Checks the delta stream the way the EBS has to: sequence numbers
+        # without gaps, deltas only on top of a keyframe, and string tables
+        # that continue where the last message left off.
+        state = self.channels.setdefault(channel, _Channel())
+        if body[u'keyframe']:
+            state.seq = body[u'seq']
+            state.awaiting_keyframe = False
+        elif state.seq is None or body[u'seq'] != state.seq + 1:
+            return self.lost(state)
+        else:
+            state.seq = body[u'seq']
+        if u'strings_base' in body:
+            if body[u'strings_base'] == 0:
+                state.strings = []
+            elif body[u'strings_base'] != len(state.strings):
+                return self.lost(state)
+            state.strings.extend(body[u'strings'])
+        return True
+
+    def lost(self, state):
+        # Ask for a keyframe once, then ignore deltas until it arrives.
+        state.seq = None
+        if state.awaiting_keyframe:
+            return True
+        state.awaiting_keyframe = True
+        return False
+
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def finish_request(self, request, client_address):
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.ThreadingTCPServer.finish_request(self, request, client_address)
+
+
+class EBSServer:
+
+    # Plain ws:// stand-in for the D2ID extension backend: the login
+    # handshake, encoding and string table negotiation, delta stream
+    # checking with RESYNC, and throughput and latency counts.
+
+    def __init__(self, address=DEFAULT_ADDRESS, users=None, encodings=None,
+                 string_tables=True):
+        # users maps name to key; without it any non empty pair logs in.
+        self.users = users
+        self.encodings = encodings or codec.supported()
+        self.string_tables = string_tables
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.counts = {'connections': 0, 'rejected': 0, 'resyncs': 0, 'messages': 0, 'bytes': 0}
+        self.versions = {}
+        # Receive time minus the update's own timestamp; client and server
+        # share a clock when both run on one machine.
+        self.latency = Histogram('ebs_update_latency_seconds', 'Update timestamp to receipt.')
+        self.server = _TCPServer(address, _Handler)
+        self.server.owner = self
+        self.address = self.server.server_address
+        self.thread = None
+
+    def negotiate(self, offered):
+        for name in (offered or '').split(','):
+            name = name.strip().lower()
+            if name in self.encodings:
+                return name
+        return codec.LEGACY
+
+    def authenticate(self, user, key):
+        if not user or not key:
+            return False
+        if self.users is None:
+            return True
+        return self.users.get(user) == key
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def attach(self, handler, version):
+        with self.lock:
+            self.clients.add(handler)
+            self.counts['connections'] += 1
+            self.versions[version] = self.versions.get(version, 0) + 1
+
+    def detach(self, handler):
+        with self.lock:
+            self.clients.discard(handler)
+
+    def received(self, size, latency):
+        with self.lock:
+            self.counts['messages'] += 1
+            self.counts['bytes'] += size
+        self.latency.observe(latency)
+
+    def kick(self):
+        # Drops every client at once, to exercise reconnect backoff.
+        with self.lock:
+            clients = list(self.clients)
+        for handler in clients:
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        return len(clients)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['clients'] = len(self.clients)
+        return stats
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.kick()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the D2ID EBS.')
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--users', help='JSON file mapping usernames to keys')
+    parser.add_argument('--encodings', help='comma separated encodings to accept')
+    parser.add_argument('--no-strings', action='store_true', help='refuse string tables')
+    parser.add_argument('--report', type=float, default=10.0, help='seconds between reports')
+    args = parser.parse_args()
+
+    users = None
+    if args.users:
+        with open(args.users, 'r') as f:
+            users = json.load(f)
+    server = EBSServer(
+        (DEFAULT_ADDRESS[0], args.port), users,
+        args.encodings and [e.strip() for e in args.encodings.split(',')],
+        not args.no_strings
+    ).start()
+    print 'Serving ws://%s:%d%s' % (server.address + (UPDATE_PATH,))
+    try:
+        while True:
+            time.sleep(args.report)
+            stats = server.stats()
+            print '%(clients)d clients, %(messages)d messages, %(bytes)d bytes, ' \
+                '%(resyncs)d resyncs, %(rejected)d rejected' % stats, \
+                '| latency p50 %.1f ms p99 %.1f ms' % (
+                    server.latency.quantile(0.5) * 1000, server.latency.quantile(0.99) * 1000
+                )
+    except KeyboardInterrupt:
+        server.stop()
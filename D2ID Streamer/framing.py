@@ -0,0 +1,34 @@
+import struct
+
+HEADER = struct.Struct('i')
+SIZEOF_INT = HEADER.size
+INITIAL_BUFFER_SIZE = 16384
+
+
+class FrameReader:
+
+    def __init__(self, transport, initial_size=INITIAL_BUFFER_SIZE):
+        self.transport = transport
+        self.header = bytearray(SIZEOF_INT)
+        self.buffer = bytearray(initial_size)
+
+    def _fill(self, view):
+        filled = 0
+        size = len(view)
+        while filled < size:
+            filled += self.transport.readinto(view[filled:])
+
+    def read_frame(self):
+        # Returns a view into a buffer that is reused for the next frame, so
+        # callers must finish with (or copy) it before reading again.
+        self._fill(memoryview(self.header))
+        length = HEADER.unpack_from(self.header)[0]
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        view = memoryview(self.buffer)[:length]
+        self._fill(view)
+        return view
+
+
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
@@ -0,0 +1,184 @@
+import time
+
+# Taken before anything else is imported, for the startup time report.
+START = time.time()
+
+import sys
+import argparse
+from threading import Event, Lock
+
+LOG_INTERVAL = 0.5
+SHUTDOWN_TIMEOUT = 5.0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Stream Diablo II items to the D2ID extension without the GUI.'
+    )
+    parser.add_argument('--username', help='Twitch username')
+    parser.add_argument('--key', help='extension key from the D2ID config panel')
+    parser.add_argument(
+        '--config', default='config',
+        help='file with the username and key on two lines, as saved by the GUI'
+    )
+    parser.add_argument('--url', help='EBS update endpoint, e.g. ws://127.0.0.1:47401/update')
+    parser.add_argument('--log', help='also append the log to this file')
+    parser.add_argument(
+        '--history', metavar='FILE',
+        help='keep a gear history in this file, for history.py queries'
+    )
+    parser.add_argument('--quiet', action='store_true', help='do not log to stdout')
+    parser.add_argument('--delta', action='store_true', help='send delta updates')
+    parser.add_argument(
+        '--snapshots', action='store_true',
+        help='read items from DiabloInterface shared memory when it publishes them'
+    )
+    parser.add_argument(
+        '--event-loop', action='store_true',
+        help='run everything on one event loop thread'
+    )
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics on this local port'
+    )
+    parser.add_argument(
+        '--metrics-summary', type=float, metavar='SECONDS',
+        help='log a metrics summary this often'
+    )
+    return parser.parse_args(argv)
+
+
+def load_credentials(args):
+    username, key = args.username, args.key
+    if username is None or key is None:
+        try:
+            with open(args.config, 'r') as conf:
+                username = username or conf.readline().strip('\n')
+                key = key or conf.readline().strip('\n')
+        except IOError:
+            pass
+    return username, key
+
+
+def resident_memory():
+    # Peak resident set size in MB, where the platform reports it.
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+class ConsoleLog:
+
+    def __init__(self, path=None, stdout=True):
+        self.path = path
+        self.stdout = stdout
+        self.lock = Lock()
+
+    def write(self, lines):
+        text = ''.join(
+            time.strftime('[%H:%M:%S] ', time.localtime(ts)) + message + '\n'
+            for ts, message, leading_newline in lines
+        )
+        with self.lock:
+            if self.stdout:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            if self.path is not None:
+                with open(self.path, 'a') as log:
+                    log.write(text)
+
+
+def main(argv):
+    args = parse_args(argv)
+    username, key = load_credentials(args)
+    if not username or not key:
+        sys.stderr.write('A username and key are needed, from --username/--key or %s\n' % args.config)
+        return 2
+
+    # Only what streaming needs; Tkinter and pygubu never load.
+    from signals import SignalRegistry
+    from log_sink import LogSink
+    from ebs import EBSConnection
+    from item_state import InventoryComparator, load_channels
+
+    with open('error.log', 'w') as log:
+        log.write('-' * 80 + '\n')
+        log.write(time.strftime('%m-%d-%Y @ %H:%M:%S\n'))
+        log.write('-' * 80 + '\n')
+
+    registry = SignalRegistry()
+    sink = LogSink()
+    output = ConsoleLog(args.log, not args.quiet)
+    registry.register('log', sink.put)
+
+    runtime = None
+    if args.event_loop:
+        from runtime import EventLoop
+        runtime = EventLoop().start()
+
+    if args.metrics_port is not None or args.metrics_summary:
+        from metrics import MetricsServer, MetricsReporter
+        if args.metrics_port is not None:
+            server = MetricsServer(('127.0.0.1', args.metrics_port)).start()
+            registry.emit('log', 'Serving metrics on http://%s:%d/metrics' % server.address)
+        if args.metrics_summary:
+            MetricsReporter(registry, args.metrics_summary).start()
+
+    channels = load_channels(registry=registry)
+    ebs = EBSConnection(
+        registry, args.delta,
+        channels=channels and [channel for channel, transport in channels],
+        runtime=runtime, url=args.url
+    )
+    comparator = InventoryComparator(
+        registry, channels=channels, runtime=runtime, snapshots=args.snapshots
+    )
+    if args.history:
+        from history import record_history
+        record_history(
+            registry, args.history, channels and [channel for channel, transport in channels]
+        )
+
+    finished = Event()
+    state = {'logged_in': False}
+
+    def on_logged_in():
+        state['logged_in'] = True
+        registry.emit('start diff loop')
+
+    def on_disconnected(message=None):
+        registry.emit('stop diff loop')
+        finished.set()
+
+    registry.register('logged in', on_logged_in)
+    registry.register('ws thread join', on_disconnected)
+    registry.register('ws thread return', on_disconnected)
+
+    registry.emit('ebs connect', username, key)
+    memory = resident_memory()
+    registry.emit('log', 'Started in %.0f ms%s.' % (
+        (time.time() - START) * 1000,
+        ', %.1f MB resident' % memory if memory is not None else ''
+    ))
+
+    try:
+        while not finished.is_set():
+            finished.wait(LOG_INTERVAL)
+            output.write(sink.drain())
+    except KeyboardInterrupt:
+        registry.emit('stop diff loop')
+        registry.emit('ebs disconnect')
+        finished.wait(SHUTDOWN_TIMEOUT)
+    if runtime is not None:
+        runtime.stop()
+    output.write(sink.drain())
+    return 0 if state['logged_in'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
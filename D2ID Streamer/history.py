@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from item_state import SLOT_COUNT, EQUIPMENT_SLOTS, fingerprint, intern_item
+
+MAGIC = 'D2IDHIS1'
+FILE_HEADER = struct.Struct('<8s')
+# Records in a history file, each after a one byte tag: an item the first
+# time it is seen (id, JSON length, JSON), and a change (timestamp, slot,
+# item id; id 0 is an emptied slot).
+ITEM_TAG = 'I'
+CHANGE_TAG = 'C'
+ITEM_RECORD = struct.Struct('<II')
+CHANGE_RECORD = struct.Struct('<dBI')
+
+# Full equipment state saved every this many changes, so a point in time
+# query replays at most this many changes.
+CHECKPOINT_EVERY = 64
+# About 13 bytes per change plus checkpoints, so 4 MB at most. The oldest
+# half is dropped from memory (the spill file keeps it) when it fills up.
+MAX_CHANGES = 1 << 18
+
+
+class HistoryError(Exception):
+    pass
+
+
+class GearHistory:
+
+    # Append only, columnar log of equipment changes: one array each for
+    # timestamps, slots and item ids, and a table of the distinct items.
+    # Items are the ones ItemState already interned, so the log holds
+    # references rather than copies.
+
+    def __init__(self, spill=None, channel=None, checkpoint_every=CHECKPOINT_EVERY,
+                 max_changes=MAX_CHANGES):
+        self.channel = channel
+        self.checkpoint_every = checkpoint_every
+        self.max_changes = max_changes
+        self.lock = Lock()
+
+        self.times = array('d')
+        self.slots = array('B')
+        self.item_ids = array('I')
+        # SLOT_COUNT item ids per checkpoint; checkpoint k is the state
+        # before change k * checkpoint_every.
+        self.checkpoints = array('I')
+        self.state = array('I', [0] * SLOT_COUNT)
+        self.items = [None]
+        self.ids = {}
+
+        # Changes dropped from the front to bound memory, and the time of
+        # the last of them: the first checkpoint holds from then on.
+        self.dropped = 0
+        self.base_time = None
+
+        self.spill = None
+        if spill is not None:
+            if os.path.exists(spill) and os.path.getsize(spill):
+                # Carry on an earlier session's file, ids and all, after
+                # cutting off whatever follows its last whole record.
+                end = self._load(spill)
+                with open(spill, 'r+b') as f:
+                    f.truncate(end)
+            self.spill = open(spill, 'ab')
+            if self.spill.tell() == 0:
+                self.spill.write(FILE_HEADER.pack(MAGIC))
+                self.spill.flush()
+
+    @classmethod
+    def load(cls, path):
+        # Everything in a spill file, for queries after the stream.
+        history = cls(max_changes=sys.maxint)
+        history._load(path)
+        return history
+
+    def _load(self, path):
+        # Returns the offset after the last whole record. A record cut short
+        # by a crash while writing, and anything after it, is ignored.
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:FILE_HEADER.size] != MAGIC:
+            raise HistoryError('%s is not a gear history file' % path)
+        offset = FILE_HEADER.size
+        while offset < len(data):
+            tag = data[offset]
+            start = offset + 1
+            if tag == ITEM_TAG and start + ITEM_RECORD.size <= len(data):
+                item_id, length = ITEM_RECORD.unpack_from(data, start)
+                start += ITEM_RECORD.size
+                if not item_id or start + length > len(data):
+                    break
+                try:
+                    item = intern_item(json.loads(data[start:start + length], encoding='utf-8'))
+                except ValueError:
+                    break
+                while len(self.items) <= item_id:
+                    self.items.append(None)
+                self.items[item_id] = item
+                self.ids[fingerprint(item)] = item_id
+                offset = start + length
+            elif tag == CHANGE_TAG and start + CHANGE_RECORD.size <= len(data):
+                ts, slot, item_id = CHANGE_RECORD.unpack_from(data, start)
+                if slot >= SLOT_COUNT or item_id >= len(self.items) or \
+                        (item_id and self.items[item_id] is None):
+                    break
+                self._append(ts, slot, item_id)
+                offset = start + CHANGE_RECORD.size
+            else:
+                break
+        return offset
+
+    def _item_id(self, item):
+        if item is None:
+            return 0
+        key = fingerprint(item)
+        item_id = self.ids.get(key)
+        if item_id is None:
+            item_id = self.ids[key] = len(self.items)
+            self.items.append(item)
+            if self.spill is not None:
+                payload = json.dumps(item, separators=(',', ':'))
+                self.spill.write(ITEM_TAG + ITEM_RECORD.pack(item_id, len(payload)) + payload)
+        return item_id
+
+    def _append(self, ts, slot, item_id):
+        # Timestamps only move forward, so queries can bisect them.
+        if self.times and ts < self.times[-1]:
+            ts = self.times[-1]
+        if len(self.times) % self.checkpoint_every == 0:
+            self.checkpoints.extend(self.state)
+        self.times.append(ts)
+        self.slots.append(slot)
+        self.item_ids.append(item_id)
+        self.state[slot] = item_id
+        if self.spill is not None:
+            self.spill.write(CHANGE_TAG + CHANGE_RECORD.pack(ts, slot, item_id))
+        if len(self.times) >= self.max_changes:
+            self._trim()
+
+    def _trim(self):
+        every = self.checkpoint_every
+        drop = len(self.times) // 2 // every * every
+        if not drop:
+            return
+        self.base_time = self.times[drop - 1]
+        del self.times[:drop]
+        del self.slots[:drop]
+        del self.item_ids[:drop]
+        del self.checkpoints[:drop // every * SLOT_COUNT]
+        self.dropped += drop
+
+    def record(self, diff, ts=None):
+        if ts is None:
+            ts = diff.detected or time.time()
+        with self.lock:
+            for slot in diff.removed:
+                self._append(ts, slot, 0)
+            for item in diff.added:
+                self._append(ts, item[u'Location'], self._item_id(item))
+            if self.spill is not None:
+                self.spill.flush()
+
+    def record_snapshot(self, snapshot, ts=None):
+        # For updates without a diff (resyncs); only real changes are kept.
+        if ts is None:
+            ts = time.time()
+        with self.lock:
+            for slot in EQUIPMENT_SLOTS:
+                item_id = self._item_id(snapshot.get(slot))
+                if item_id != self.state[slot]:
+                    self._append(ts, slot, item_id)
+            if self.spill is not None:
+                self.spill.flush()
+
+    def on_update(self, snapshot, diff=None, channel=None):
+        if channel != self.channel:
+            return
+        if diff is None:
+            self.record_snapshot(snapshot)
+        else:
+            self.record(diff)
+
+    def __len__(self):
+        return len(self.times)
+
+    def span(self):
+        # (first, last) timestamp held in memory, or None when empty.
+        if not self.times:
+            return None
+        return self.base_time or self.times[0], self.times[-1]
+
+    def _state_at(self, ts):
+        # Item ids per slot at ts, or None before the history held.
+        n = bisect_right(self.times, ts)
+        if n == 0 and (self.base_time is None or ts < self.base_time):
+            return None
+        every = self.checkpoint_every
+        k = min(n // every, len(self.checkpoints) // SLOT_COUNT - 1)
+        state = self.checkpoints[k * SLOT_COUNT:(k + 1) * SLOT_COUNT]
+        for i in xrange(k * every, n):
+            state[self.slots[i]] = self.item_ids[i]
+        return state
+
+    def at(self, ts):
+        # What was equipped at ts, as {slot: item} like ItemState.snapshot().
+        with self.lock:
+            state = self._state_at(ts)
+            if state is None:
+                return None
+            return dict((slot, self.items[state[slot]]) for slot in EQUIPMENT_SLOTS)
+
+    def between(self, start, end):
+        # Changes with start <= ts < end, as (ts, slot, item).
+        with self.lock:
+            first = bisect_left(self.times, start)
+            last = bisect_left(self.times, end)
+            return [
+                (self.times[i], self.slots[i], self.items[self.item_ids[i]])
+                for i in xrange(first, last)
+            ]
+
+    def worn(self, start, end):
+        # Seconds each item spent equipped between start and end, as
+        # {slot: [(item, seconds), ...]} with the longest worn first.
+        with self.lock:
+            state = self._state_at(start)
+            if state is None:
+                if not self.times:
+                    return {}
+                start = self.base_time or self.times[0]
+                state = self._state_at(start)
+            since = [start] * SLOT_COUNT
+            seconds = [{} for _ in xrange(SLOT_COUNT)]
+            first = bisect_right(self.times, start)
+            last = bisect_left(self.times, end)
+            for i in xrange(first, last):
+                slot, ts = self.slots[i], self.times[i]
+                totals = seconds[slot]
+                totals[state[slot]] = totals.get(state[slot], 0) + ts - since[slot]
+                state[slot] = self.item_ids[i]
+                since[slot] = ts
+            worn = {}
+            for slot in EQUIPMENT_SLOTS:
+                totals = seconds[slot]
+                totals[state[slot]] = totals.get(state[slot], 0) + end - since[slot]
+                worn[slot] = sorted(
+                    ((self.items[item_id], total) for item_id, total in totals.items()
+                     if item_id and total > 0),
+                    key=lambda entry: -entry[1]
+                )
+            return worn
+
+    def memory(self):
+        # Bytes held by the columns and checkpoints, not counting items.
+        return sum(
+            column.itemsize * len(column)
+            for column in (self.times, self.slots, self.item_ids, self.checkpoints)
+        )
+
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+
+def record_history(registry, path, channels=None):
+    # One history per item source, recording every published update.
+    histories = []
+    for channel in channels or [None]:
+        spill = path if channel is None else '%s.%s' % (path, channel)
+        history = GearHistory(spill, channel)
+        registry.register('update', history.on_update)
+        histories.append(history)
+    return histories
+
+
+def parse_offset(text):
+    # Seconds, or h:mm:ss, from the start of the session.
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def format_offset(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return '%d:%02d:%02d' % (minutes // 60, minutes % 60, seconds)
+
+
+def summary(path):
+    history = GearHistory.load(path)
+    span = history.span()
+    if span is None:
+        print '%s: no changes' % path
+        return
+    start, end = span
+    print '%s: %d changes, %d items over %s' % (
+        path, len(history), len(history.items) - 1, format_offset(end - start)
+    )
+    for slot, worn in sorted(history.worn(start, end).items()):
+        for item, seconds in worn:
+            print '  %2d %-40s %s' % (slot, item[u'ItemName'], format_offset(seconds))
+
+
+def show_at(path, offset):
+    history = GearHistory.load(path)
+    span = history.span()
+    if span is None:
+        print '%s: no changes' % path
+        return
+    gear = history.at(span[0] + parse_offset(offset))
+    for slot in EQUIPMENT_SLOTS:
+        item = gear and gear[slot]
+        print '  %2d %s' % (slot, item[u'ItemName'] if item else '-')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('summary', 'at') or \
+            (sys.argv[1] == 'at' and len(sys.argv) < 4):
+        print 'usage: history.py summary <file> | at <file> <h:mm:ss>'
+        sys.exit(1)
+    if sys.argv[1] == 'summary':
+        summary(sys.argv[2])
+    else:
+        show_at(sys.argv[2], sys.argv[3])
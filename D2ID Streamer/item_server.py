@@ -0,0 +1,437 @@
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import SocketServer
+from framing import HEADER, SIZEOF_INT, encode_frame
+from pipe import CONNECT_OK, CONNECT_BUSY, CONNECT_NOT_FOUND
+from snapshot import SnapshotWriter, HEARTBEAT_INTERVAL
+
+DEFAULT_ADDRESS = ('127.0.0.1', 47400)
+
+# BodyLocation values as serialized by DiabloInterface.
+HEAD            = 1
+AMULET          = 2
+BODY_ARMOR      = 3
+PRIMARY_LEFT    = 4
+PRIMARY_RIGHT   = 5
+RING_LEFT       = 6
+RING_RIGHT      = 7
+BELT            = 8
+BOOTS           = 9
+GLOVES          = 10
+SECONDARY_LEFT  = 11
+SECONDARY_RIGHT = 12
+
+ALL_LOCATIONS = range(HEAD, SECONDARY_RIGHT + 1)
+
+SLOT_LOCATIONS = {
+    'helm':             [HEAD],
+    'head':             [HEAD],
+    'armor':            [BODY_ARMOR],
+    'body':             [BODY_ARMOR],
+    'torso':            [BODY_ARMOR],
+    'amulet':           [AMULET],
+    'ring':             [RING_LEFT, RING_RIGHT],
+    'rings':            [RING_LEFT, RING_RIGHT],
+    'belt':             [BELT],
+    'glove':            [GLOVES],
+    'gloves':           [GLOVES],
+    'hand':             [GLOVES],
+    'boot':             [BOOTS],
+    'boots':            [BOOTS],
+    'foot':             [BOOTS],
+    'feet':             [BOOTS],
+    'primary':          [PRIMARY_LEFT],
+    'weapon':           [PRIMARY_LEFT],
+    'offhand':          [PRIMARY_RIGHT],
+    'shield':           [PRIMARY_RIGHT],
+    'weapon2':          [SECONDARY_LEFT],
+    'secondary':        [SECONDARY_LEFT],
+    'secondaryshield':  [SECONDARY_RIGHT],
+    'secondaryoffhand': [SECONDARY_RIGHT],
+    'shield2':          [SECONDARY_RIGHT]
+}
+
+SAMPLE_ITEMS = [
+    {
+        u'ItemName': u'Harlequin Crest',
+        u'BaseItem': u'Shako',
+        u'Quality': u'GOLD',
+        u'Location': HEAD,
+        u'Properties': [
+            u'+2 to All Skills',
+            u'+2 to Life (Based on Character Level)',
+            u'+2 to Mana (Based on Character Level)',
+            u'50% Damage Reduced',
+            u'50% Better Chance of Getting Magic Items',
+            u'+2 to All Attributes'
+        ]
+    },
+    {
+        u'ItemName': u'Enigma',
+        u'BaseItem': u'Mage Plate',
+        u'Quality': u'WHITE',
+        u'Location': BODY_ARMOR,
+        u'Properties': [
+            u'+2 to All Skills',
+            u'+45% Faster Run/Walk',
+            u'+1 to Teleport',
+            u'+750 Defense',
+            u'+74 to Strength (Based on Character Level)',
+            u'Increase Maximum Life 5%',
+            u'Damage Reduced by 8%',
+            u'+14 Life after each Kill',
+            u'15% Damage Taken Goes To Mana',
+            u'+99% Better Chance of Getting Magic Items (Based on Character Level)'
+        ]
+    },
+    {
+        u'ItemName': u'Spirit',
+        u'BaseItem': u'Crystal Sword',
+        u'Quality': u'WHITE',
+        u'Location': PRIMARY_LEFT,
+        u'Properties': [
+            u'+2 to All Skills',
+            u'+25% Faster Cast Rate',
+            u'+55% Faster Hit Recovery',
+            u'+250 Defense Vs. Missile',
+            u'+22 to Vitality',
+            u'+112 to Mana',
+            u'Cold Resist +35%',
+            u'Lightning Resist +35%',
+            u'Poison Resist +35%',
+            u'+8 Magic Absorb',
+            u'Attacker Takes Damage of 14'
+        ]
+    },
+    {
+        u'ItemName': u'The Stone of Jordan',
+        u'BaseItem': u'Ring',
+        u'Quality': u'GOLD',
+        u'Location': RING_LEFT,
+        u'Properties': [
+            u'+1 to All Skills',
+            u'Adds 1-12 Lightning Damage',
+            u'+20 to Mana',
+            u'Increase Maximum Mana 25%'
+        ]
+    },
+    {
+        u'ItemName': u'Arachnid Mesh',
+        u'BaseItem': u'Spiderweb Sash',
+        u'Quality': u'GOLD',
+        u'Location': BELT,
+        u'Properties': [
+            u'+1 to All Skills',
+            u'+20% Faster Cast Rate',
+            u'Slows Target by 10%',
+            u'Increase Maximum Mana 5%',
+            u'Level 3 Venom (11 Charges)'
+        ]
+    }
+]
+
+
+def _read_exact(rfile, size):
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        owner = self.server.owner
+        status = owner.admit(self.request)
+        try:
+            self.wfile.write(status)
+            self.wfile.flush()
+            if status != CONNECT_OK:
+                return
+            # Serve requests until the client hangs up, like a held pipe handle.
+            while True:
+                header = _read_exact(self.rfile, SIZEOF_INT)
+                if header is None:
+                    return
+                length = HEADER.unpack(header)[0]
+                body = _read_exact(self.rfile, length)
+                if body is None:
+                    return
+                # Hanging up without an answer loses the connection; the
+                # client has to reconnect.
+                if not owner.available():
+                    return
+                if owner.latency:
+                    time.sleep(owner.latency)
+                response = owner.handle_query(json.loads(body, encoding='utf-8'))
+                payload = json.dumps(response, encoding='utf-8')
+                self.wfile.write(encode_frame(payload))
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            if status == CONNECT_OK:
+                with owner.lock:
+                    owner.clients.discard(self.request)
+
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def finish_request(self, request, client_address):
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.ThreadingTCPServer.finish_request(self, request, client_address)
+
+
+def equipment_fingerprint(items):
+    # Same shape as DiabloInterface's UpdateGeneration: each location's item
+    # identity (name and base item here, GUID and class there) folded in
+    # location order, so items trading places change it. Properties do not.
+    fingerprint = 17
+    for location in ALL_LOCATIONS:
+        item = items.get(location)
+        identity = hash((item[u'ItemName'], item.get(u'BaseItem'))) if item else 0
+        fingerprint = (fingerprint * 31 + identity) & 0xFFFFFFFF
+    return fingerprint
+
+
+class ItemServer:
+
+    def __init__(self, address=DEFAULT_ADDRESS, items=None, batching=True,
+                 versioning=True, latency=0.0, drop_rate=0.0, snapshots=None,
+                 single_client=False):
+        self.batching = batching
+        self.versioning = versioning
+        self.latency = latency
+        self.drop_rate = drop_rate
+        # DiabloInterface serves one pipe instance: a second client that
+        # connects meanwhile is told the pipe is busy.
+        self.single_client = single_client
+        self.down_until = 0
+        self.refuse_until = 0
+        self.lock = threading.Lock()
+        self.items = {}
+        self.generation = 0
+        self.fingerprint = None
+        self.changes = []
+        self.clients = set()
+        self.connections = 0
+        self.requests = 0
+        self.dropped = 0
+        self.busy = 0
+        self.refused = 0
+        self.server = _TCPServer(address, _Handler)
+        self.server.owner = self
+        self.address = self.server.server_address
+        self.thread = None
+        # Also publish every change to this shared memory region, like
+        # DiabloInterface with ItemServerSnapshots set.
+        self.snapshots = snapshots and SnapshotWriter(snapshots)
+        self.stopped = threading.Event()
+        self.set_items(items or [])
+
+    def _changed(self):
+        fingerprint = equipment_fingerprint(self.items)
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.generation += 1
+        self.changes.append(time.time())
+        if self.snapshots:
+            items = [self.items[l] for l in ALL_LOCATIONS if l in self.items]
+            self.snapshots.write(self.generation, items)
+
+    def _heartbeat(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            self.snapshots.beat()
+
+    def set_items(self, items):
+        with self.lock:
+            self.items = dict((item[u'Location'], item) for item in items)
+            self._changed()
+
+    def equip(self, item):
+        with self.lock:
+            self.items[item[u'Location']] = item
+            self._changed()
+
+    def unequip(self, location):
+        with self.lock:
+            if self.items.pop(location, None) is not None:
+                self._changed()
+
+    def admit(self, client):
+        with self.lock:
+            if time.time() < self.refuse_until:
+                self.refused += 1
+                return CONNECT_NOT_FOUND
+            if self.single_client and self.clients:
+                self.busy += 1
+                return CONNECT_BUSY
+            self.connections += 1
+            self.clients.add(client)
+            return CONNECT_OK
+
+    def outage(self, seconds, refuse=False):
+        # By default open connections hang up on every request (connection
+        # lost). A refusing outage is DiabloInterface gone: connections are
+        # closed and new ones find no pipe until it is over.
+        if refuse:
+            self.refuse_until = time.time() + seconds
+            self.disconnect_clients()
+        else:
+            self.down_until = time.time() + seconds
+
+    def available(self):
+        if time.time() < self.down_until or \
+                (self.drop_rate and random.random() < self.drop_rate):
+            self.dropped += 1
+            return False
+        return True
+
+    def run_script(self, script, speed=1.0):
+        for step in script:
+            if u'wait' in step:
+                time.sleep(step[u'wait'] / speed)
+            elif u'equip' in step:
+                self.equip(step[u'equip'])
+            elif u'unequip' in step:
+                self.unequip(step[u'unequip'])
+            elif u'set' in step:
+                self.set_items(step[u'set'])
+            elif u'outage' in step:
+                self.outage(step[u'outage'] / speed, step.get(u'refuse', False))
+
+    def play(self, script, speed=1.0):
+        thread = threading.Thread(target=self.run_script, args=(script, speed))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _query_locations(self, query):
+        slots = []
+        if query.get(u'EquipmentSlot'):
+            slots.append(query[u'EquipmentSlot'])
+        if self.batching:
+            slots.extend(query.get(u'EquipmentSlots') or [])
+        locations = []
+        for slot in slots:
+            slot = slot.lower()
+            if slot == u'all' and self.batching:
+                locations.extend(ALL_LOCATIONS)
+            else:
+                locations.extend(SLOT_LOCATIONS.get(slot, []))
+        return sorted(set(locations))
+
+    def handle_query(self, query):
+        self.requests += 1
+        if query.get(u'Resource') == u'generation' and self.versioning:
+            with self.lock:
+                generation = self.generation
+            return {
+                u'IsValid': True,
+                u'Success': True,
+                u'Generation': generation,
+                u'Items': []
+            }
+        locations = self._query_locations(query)
+        with self.lock:
+            items = [self.items[l] for l in locations if l in self.items]
+        return {
+            u'IsValid': len(locations) > 0,
+            u'Success': len(items) > 0,
+            u'Generation': 0,
+            u'Items': items
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        if self.snapshots:
+            self.snapshots.beat()
+            heartbeat = threading.Thread(target=self._heartbeat)
+            heartbeat.daemon = True
+            heartbeat.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.disconnect_clients()
+
+    def disconnect_clients(self):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def swap_script(items, swaps, interval, seed=None):
+    # Alternates each picked slot between its sample item and a renamed
+    # copy, so every step is a real change the client has to publish.
+    rng = random.Random(seed)
+    script = []
+    swapped = set()
+    for _ in xrange(swaps):
+        item = rng.choice(items)
+        location = item[u'Location']
+        if location in swapped:
+            swapped.discard(location)
+            script.append({u'equip': item})
+        else:
+            swapped.add(location)
+            replacement = dict(item, ItemName=item[u'ItemName'] + u' (swapped)')
+            script.append({u'equip': replacement})
+        script.append({u'wait': interval})
+    return script
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the DiabloInterface item server.')
+    parser.add_argument('items', nargs='?', help='JSON file with a list of items to serve')
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of requests answered by hanging up')
+    parser.add_argument(
+        '--single-client', action='store_true',
+        help='answer a second concurrent client with busy, like the real pipe'
+    )
+    parser.add_argument('--legacy', action='store_true', help='no batched queries or generations')
+    parser.add_argument('--script', help='JSON file with gear swap steps to play')
+    parser.add_argument('--swaps', type=int, default=0, help='play this many random swaps')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between random swaps')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--snapshots', metavar='NAME', help='also publish to this shared memory region')
+    args = parser.parse_args()
+
+    items = SAMPLE_ITEMS
+    if args.items:
+        with open(args.items, 'r') as f:
+            items = json.load(f)
+    server = ItemServer(
+        (DEFAULT_ADDRESS[0], args.port), items,
+        batching=not args.legacy, versioning=not args.legacy,
+        latency=args.latency, drop_rate=args.drop_rate, snapshots=args.snapshots,
+        single_client=args.single_client
+    )
+    print 'Serving %d items on %s:%d' % ((len(items),) + server.address)
+    if args.script:
+        with open(args.script, 'r') as f:
+            server.play(json.load(f), args.speed)
+    elif args.swaps:
+        server.play(swap_script(items, args.swaps, args.interval), args.speed)
+    try:
+        server.start()
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,139 +1,113 @@
 import json
 import time
-import struct
-import pywintypes
-from ctypes import sizeof, c_int
-from win32file import *
-from win32pipe import *
-from threading import Thread
-from tests import VerboseTrace
+from pipe import PipeSession, Win32PipeTransport, pipe_path
+from threading import Thread, Timer, Lock, Event
+from tracing import tracer
+from metrics import metrics
+from capture import CaptureWriter
+from snapshot import SnapshotSource, snapshot_name
 import traceback
 
-DI_PIPE_BUF_SIZE = 1024
-SIZEOF_INT = sizeof(c_int)
 LOGGING = True
-
-err = VerboseTrace(False)
+TRACING = False
+# Set to a file name to record every item set read from the pipe.
+CAPTURE_PATH = None
+# Read items from DiabloInterface's shared memory snapshots while it
+# publishes them (ItemServerSnapshots in its settings), else the pipe.
+SNAPSHOTS = False
+# Polling cadence: fast while a change settles, POLL_INTERVAL normally,
+# backing off towards MAX_POLL_INTERVAL once nothing changed for IDLE_AFTER.
+POLL_INTERVAL = 0.1
+FAST_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+IDLE_AFTER = 10.0
+IDLE_BACKOFF = 1.5
+CHANNELS_PATH = 'channels'
+FULL_REFRESH_INTERVAL = 5.0
+QUIET_PERIOD = 0.5
+MAX_LATENCY = 2.0
+SLOT_COUNT = 13
+EQUIPMENT_SLOTS = range(1, SLOT_COUNT)
+
+READ_ERRORS = metrics.counter(
+    'd2id_read_errors_total', 'Exceptions in the item read loop, as logged to error.log.'
+)
+ITEM_CHANGES = metrics.counter('d2id_item_changes_total', 'Slots changed in published updates.')
+POLL_INTERVAL_GAUGE = metrics.gauge('d2id_poll_interval_seconds', 'Current polling interval.')
+
+SLOTS = [
+    'helm',
+    'armor',
+    'amulet',
+    'rings',
+    'belt',
+    'gloves',
+    'boots',
+    'weapon',
+    'shield',
+    'weapon2',
+    'shield2'
+]
 
 class PipeHandler:
 
-    def __init__(self, registry):
+    def __init__(self, registry, transport=None, batched=True, session=None):
         self.registry = registry
-        self.pipe_name = r'\\.\pipe\DiabloInterfaceItems'
-
-    def _construct_query(self, json_dict):
-        s = json.dumps(json_dict, encoding='utf-8')
-        return struct.pack('i', len(s)) + s
+        if transport is None:
+            transport = Win32PipeTransport()
+        # PipeSession keyword arguments, e.g. {'max_retries': 0}.
+        self.session = PipeSession(transport, **(session or {}))
+        self.batched = batched
+        self.versioned = True
 
     def _transact(self, query):
-        err.add_line('Constructing packet')
-        packet = self._construct_query(query)
-        retries = 0
+        return self.session.transact(query)
+
+    def close(self):
+        self.session.close()
+
+    def get_generation(self):
+        if not self.versioned:
+            return None
+        response = self._transact({'Resource': 'generation'})
+        if response['IsValid']:
+            return response['Generation']
+        # Older DiabloInterface builds have no change counter; the caller
+        # has to fall back to pulling the full item set every time.
+        self.versioned = False
+        self.registry.emit(
+            'log',
+            'DiabloInterface does not report item changes, ' +\
+            'falling back to reading all items on every poll.'
+        )
+        return None
 
-        while True:
-            if retries > 10:
-                raise
+    def _batch_query(self, slots):
+        if slots is None:
+            return {'EquipmentSlot': 'all'}
+        return {'EquipmentSlots': list(slots)}
+
+    def get_items(self, slots=None):
+        if self.batched:
+            response = self._transact(self._batch_query(slots))
+            if response['IsValid']:
+                return response['Items']
+            # Older DiabloInterface builds only understand one slot per query.
+            self.batched = False
+            self.registry.emit(
+                'log',
+                'DiabloInterface does not support batched item queries, ' +\
+                'falling back to one request per slot.'
+            )
+        return self._get_items_serial(slots or SLOTS)
 
-            err.add_line('Beginning pipe connection loop')
-            try:
-                err.add_line('Getting handle to DI pipe')
-                err.timestamp()
-                handle = CreateFile(
-                    self.pipe_name,
-                    GENERIC_READ|GENERIC_WRITE,
-                    0,
-                    None,
-                    OPEN_EXISTING,
-                    0,
-                    None
-                )
-                err.add_line('Got handle to pipe')
-                err.timestamp()
-            except pywintypes.error as e:
-                err.add_line('pywintypes error: ' + str(e))
-                err.timestamp()
-                error = e[0]
-                if error == 231:
-                    err.add_line('Error code 231, waiting for busy pipe')
-                    err.timestamp()
-                    try:
-                        if WaitNamedPipe(self.pipe_name, 1000):
-                            err.add_line('Pipe connection timed out')
-                            err.timestamp()
-                    except pywintypes.error as wfpe:
-                        err.add_line('Error waiting for pipe: ' + str(wfpe))
-                        time.sleep(0.1)
-                        retries += 1
-                        continue
-                elif error == 2:
-                    err.add_line('Error code 2, pipe isn\'t yet reopened, sleep/retry')
-                    time.sleep(0.1)
-                    retries += 1
-                    continue
-                else:
-                    raise
-            else:
-                err.add_line('Breaking out of pipe connection loop')
-                err.timestamp()
-                break
-
-        err.add_line('Writing to pipe')
-        err.timestamp()
-        WriteFile(handle, packet)
-        err.add_line('Returned from writing to pipe')
-        err.timestamp()
-
-        err.add_line('Reading length of pipe response')
-        out = ReadFile(handle, DI_PIPE_BUF_SIZE)[1]
-        length = struct.unpack('i', out[:SIZEOF_INT])[0]
-        err.add_line('Length: ' + str(out))
-        err.timestamp()
-
-        err.add_line('Reading pipe payload')
-        err.timestamp()
-        while len(out) < length + SIZEOF_INT:
-            out += ReadFile(handle, DI_PIPE_BUF_SIZE)[1]
-        err.add_line('Finished reading payload')
-        err.timestamp()
-        err.add_line('Closing pipe handle')
-        err.timestamp()
-        CloseHandle(handle)
-        err.add_line('Closed pipe handle')
-        err.timestamp()
-
-        err.add_line('Parsing and returning JSON data')
-        data = json.loads(out[SIZEOF_INT:], encoding='utf-8')
-        return data
-
-    def get_items(self):
-        err.add_line('At beginning of PipeHandler.get_items')
-        slots = [
-            'helm',
-            'armor',
-            'amulet',
-            'rings',
-            'belt',
-            'gloves',
-            'boots',
-            'weapon',
-            'shield',
-            'weapon2',
-            'shield2'
-        ]
+    def _get_items_serial(self, slots):
         responses = []
-        err.add_line('Making requests...')
-        err.timestamp()
         for slot in slots:
-            err.add_line('Making pipe transaction')
             response = self._transact({'EquipmentSlot': slot})
-            err.add_line('Got pipe response')
             if response['Success']:
                 for item in response['Items']:
                     responses.append(item)
-        err.add_line('Finished making requests, returning responses')
-        err.timestamp()
-        # response = self._transact({u'Resource': u'items', u'Payload': u''})[u'Payload']
-        err.add_line('Responses: ' + str(responses))
         return responses
 
 
@@ -142,170 +116,438 @@ class Diff:
     def __init__(self, added, removed):
         self.added = added
         self.removed = removed
+        # When the first change in this diff was read from the pipe.
+        self.detected = None
 
     def length(self):
-        return len(self.added + self.removed)
+        return len(self.added) + len(self.removed)
 
     def to_dict(self):
         return {u'added': self.added, u'removed': self.removed}
 
     def to_json(self):
-        payload = {'added': self.added, 'removed': self.removed}
-        return json.dumps(json.dumps(payload))
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+
+# Every distinct string seen in an item, so the states held for the live,
+# published and (with several channels) per source copies share one object
+# per string instead of one per parse.
+STRINGS = {}
+
+
+def intern_item(item):
+    if item is None:
+        return None
+    for field in (u'ItemName', u'BaseItem', u'Quality'):
+        value = item[field]
+        item[field] = STRINGS.setdefault(value, value)
+    item[u'Properties'] = [STRINGS.setdefault(prop, prop) for prop in item[u'Properties']]
+    return item
+
+
+def fingerprint(item):
+    # Computed once per item as it comes off the pipe, so diffs compare one
+    # integer per slot instead of walking the nested item dicts.
+    return hash((
+        item[u'ItemName'],
+        item[u'BaseItem'],
+        item[u'Quality'],
+        tuple(item[u'Properties'])
+    ))
 
 
 class ItemState:
 
     def __init__(self, registry):
         self.registry = registry
-        self.current_state = {}
-        for i in range(1, 13):
-            self.current_state[i] = None
+        # Indexed by BodyLocation; slot 0 (None) is never equipped.
+        self.current_state = [None] * SLOT_COUNT
+        self.fingerprints = [None] * SLOT_COUNT
+
+    def snapshot(self):
+        return dict((slot, self.current_state[slot]) for slot in EQUIPMENT_SLOTS)
 
     def diff(self, item_set):
-        err.add_line('In ItemState.diff, processing changes')
-        err.add_line('Item set: ' + str(item_set))
-        err.timestamp()
         assert type(item_set) is list, 'diff requires list'
 
-        item_set = {item[u'Location']: item for item in item_set if item}
-        equipped = set([key for key in self.current_state.keys() if self.current_state[key]])
-        new_equipped = set(item_set.keys())
+        items = [None] * SLOT_COUNT
+        fingerprints = [None] * SLOT_COUNT
+        for item in item_set:
+            if item:
+                slot = item[u'Location']
+                items[slot] = item
+                fingerprints[slot] = fingerprint(item)
 
-        added_slots   = new_equipped.difference(equipped)
-        removed_slots = equipped.difference(new_equipped)
-        updated_slots = new_equipped.intersection(equipped)
+        return self._apply(items, fingerprints)
 
+    def _apply(self, items, fingerprints):
         added, removed = [], []
 
-        for slot in added_slots:
-            added.append(item_set[slot])
-            self.current_state[slot] = item_set[slot]
-
-        for slot in removed_slots:
-            removed.append(slot)
-            self.current_state[slot] = None
-
-        for slot in updated_slots:
-            if self.current_state[slot] != item_set[slot]:
-                added.append(item_set[slot])
-                self.current_state[slot] = item_set[slot]
+        for slot in EQUIPMENT_SLOTS:
+            if fingerprints[slot] == self.fingerprints[slot]:
+                continue
+            # Only items that changed are interned; the rest of a poll's
+            # freshly parsed items are dropped.
+            item = intern_item(items[slot])
+            if item is None:
+                removed.append(slot)
+            else:
+                added.append(item)
+            self.current_state[slot] = item
+            self.fingerprints[slot] = fingerprints[slot]
 
-        err.add_line('Returning Diff object')
-        err.timestamp()
         return Diff(added, removed)
 
 
-class DirtyItemState(ItemState):
+class Debouncer:
 
-    def __init__(self, registry):
-        ItemState.__init__(self, registry)
-        self.last_change = time.time()
-
-    def diff(self, item_set):
-        err.add_line('In DirtyState.diff, checking for changes')
-        if ItemState.diff(self, item_set).length() > 0:
-            err.add_line('Item change detected')
-            err.timestamp()
-            self.last_change = time.time()
-            err.add_line('Last change at: ' + str(self.last_change))
-        self.time_since_change = time.time() - self.last_change
-        err.add_line('Time since last change: ' + str(self.time_since_change))
-
-
-class CleanItemState(ItemState):
-
-    def __init__(self, registry):
-        ItemState.__init__(self, registry)
-
-    def diff(self, dirty_state):
-        err.add_line('In CleanState.diff, checking DirtyState')
-        if dirty_state.time_since_change > 1:
-            err.add_line('DirtyState idle for longer than 2 seconds, diffing')
-            err.timestamp()
-            diff = ItemState.diff(self, dirty_state.current_state.values())
-            err.add_line('Diff body: ' + str(diff.added + diff.removed))
-            err.add_line('Diff length: ' + str(diff.length()))
-            if diff.length() > 0:
-                err.add_line('Diff length > 0, returning current state')
-                print str(self.current_state)
-                return self.current_state
-        err.add_line('No changes, returning None')
-        err.timestamp()
-        return None
+    def __init__(self, registry, on_flush, quiet_period=QUIET_PERIOD,
+                 max_latency=MAX_LATENCY, leading=False, trailing=True, runtime=None,
+                 clock=time.time):
+        if not (leading or trailing):
+            raise ValueError('Debouncer needs a leading or trailing edge')
+        self.registry = registry
+        self.on_flush = on_flush
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+        self.leading = leading
+        self.trailing = trailing
+        # Timers go on the event loop when there is one, else on threads.
+        self.runtime = runtime
+        self.clock = clock
+
+        # Latest state read from the pipe, and the last state published.
+        self.live = ItemState(registry)
+        self.published = ItemState(registry)
+
+        self.lock = Lock()
+        self.timer = None
+        self.first_change = None
+        self.last_change = None
+        self.last_flush = 0
+
+    def feed(self, item_set):
+        with self.lock:
+            with tracer.span('diff'):
+                diff = self.live.diff(item_set)
+            if diff.length() == 0:
+                return False
+            now = self.clock()
+            tracer.event('change', len(diff.added), len(diff.removed))
+            self.last_change = now
+            if self.first_change is None:
+                self.first_change = now
+                if self.leading and now - self.last_flush >= self.quiet_period:
+                    self._flush(now)
+                    return True
+            self._schedule()
+            return True
+
+    def settling(self):
+        # A burst of changes is waiting for its quiet period.
+        return self.first_change is not None
+
+    def _deadline(self):
+        return min(
+            self.last_change + self.quiet_period,
+            self.first_change + self.max_latency
+        )
+
+    def _schedule(self):
+        # One timer per burst: when it fires early because more changes came
+        # in, it re-arms itself for the remaining time.
+        if self.timer is None:
+            delay = max(0, self._deadline() - self.clock())
+            if self.runtime is not None:
+                self.timer = self.runtime.call_later(delay, self._expire)
+            else:
+                self.timer = Timer(delay, self._expire)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _expire(self):
+        with self.lock:
+            self.timer = None
+            if self.first_change is None:
+                return
+            now = self.clock()
+            if now < self._deadline():
+                self._schedule()
+            elif self.trailing:
+                self._flush(now)
+            else:
+                # Without a trailing edge the changes wait for the next leading one.
+                self.first_change = None
+
+    def _flush(self, now):
+        detected = self.first_change
+        self.first_change = None
+        self.last_flush = now
+        diff = self.published._apply(self.live.current_state, self.live.fingerprints)
+        if diff.length() > 0:
+            diff.detected = detected
+            tracer.event('publish', diff.length())
+            ITEM_CHANGES.inc(diff.length())
+            self.on_flush(self.published.snapshot(), diff)
+
+    def flush(self):
+        with self.lock:
+            self._flush(self.clock())
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.first_change = None
+
+
+class ItemSource:
+
+    # One DiabloInterface instance: its pipe, diff state and debouncer.
+
+    def __init__(self, registry, channel=None, transport=None, source=None,
+                 debounce=None, capture=None, runtime=None, snapshots=False):
+        self.registry = registry
+        self.channel = channel
+        if source is None:
+            session = None
+            if runtime is not None:
+                # Retries and waits for a busy pipe would block everything
+                # else on the loop; the next poll round is the retry.
+                session = {'max_retries': 0, 'wait': False}
+            source = PipeHandler(registry, transport, session=session)
+            if snapshots:
+                source = SnapshotSource(registry, snapshot_name(transport), source)
+        self.pipe = source
+        self.debouncer = Debouncer(
+            registry, self.publish, runtime=runtime, **(debounce or {})
+        )
+        self.capture = CaptureWriter(capture) if capture else None
+
+        # Generation of the last item set read from the pipe, and when it
+        # was read. The full read is skipped while the generation holds
+        # still, except for a periodic refresh in case the counter misses
+        # a change the server does not fingerprint. Pending changes are
+        # flushed by the debouncer's own timer, not by the poll loop.
+        self.generation = None
+        self.refreshed = 0
+
+    def changed(self):
+        with tracer.span('generation'):
+            generation = self.pipe.get_generation()
+        now = time.time()
+        if generation is None or generation != self.generation or \
+                now - self.refreshed > FULL_REFRESH_INTERVAL:
+            self.generation = generation
+            self.refreshed = now
+            return True
+        return False
+
+    def poll(self):
+        if not self.changed():
+            return False
+        with tracer.span('get_items'):
+            items = self.pipe.get_items()
+        if self.capture is not None:
+            self.capture.record(items)
+        return self.debouncer.feed(items)
+
+    def publish(self, snapshot, diff):
+        self.registry.emit('update', snapshot, diff, self.channel)
+
+    def close(self):
+        self.debouncer.cancel()
+        self.pipe.close()
+        if self.capture is not None:
+            self.capture.close()
+
+
+class PollScheduler:
+
+    def __init__(self, interval=POLL_INTERVAL, fast_interval=FAST_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL, idle_after=IDLE_AFTER,
+                 backoff=IDLE_BACKOFF):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.max_interval = max_interval
+        self.idle_after = idle_after
+        self.backoff = backoff
+        self.current = interval
+        self.last_activity = time.time()
+
+    def next_delay(self, started, active):
+        # active: something changed this round, or is still settling.
+        now = time.time()
+        if active:
+            self.last_activity = now
+            current = self.fast_interval
+        elif now - self.last_activity < self.idle_after:
+            current = self.interval
+        else:
+            current = min(self.max_interval, max(self.current, self.interval) * self.backoff)
+        if current != self.current:
+            tracer.event('poll.interval', '%.3f' % current)
+            POLL_INTERVAL_GAUGE.set(current)
+            self.current = current
+        # Intervals run from the start of a round, so slow pipe reads do not
+        # stretch the cadence. A round that overran starts the next one at
+        # once rather than trying to catch up.
+        return max(0, started + current - now)
+
+
+def load_channels(path=CHANNELS_PATH, registry=None):
+    # One "<channel> <pipe name>" pair per line, for running several
+    # characters through one client; see README.md. No file means the
+    # single default pipe. Malformed lines are skipped (and logged).
+    channels = []
+    try:
+        with open(path, 'r') as conf:
+            for number, line in enumerate(conf, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    if registry is not None:
+                        registry.emit(
+                            'log', '%s line %d: expected "<channel> <pipe name>", skipped.' % (
+                                path, number
+                            )
+                        )
+                    continue
+                channel, pipe_name = fields
+                channels.append((channel, Win32PipeTransport(pipe_path(pipe_name))))
+    except IOError:
+        pass
+    return channels or None
 
 
 class InventoryComparator():
 
-    def __init__(self, registry):
+    def __init__(self, registry, transport=None, debounce=None, source=None,
+                 capture=CAPTURE_PATH, poll_interval=POLL_INTERVAL, channels=None,
+                 runtime=None, polling=None, snapshots=SNAPSHOTS):
         self.registry = registry
+        self.transport = transport
+        self.debounce = debounce or {}
+        # Anything with PipeHandler's get_generation/get_items/close, such
+        # as a capture.ReplaySource; the pipe is used when not given.
+        self.source = source
+        self.capture = capture
+        self.poll_interval = poll_interval
+        # PollScheduler keyword arguments, e.g. {'max_interval': 0.5}.
+        self.polling = polling or {}
+        # (channel, transport) pairs, all polled by the one reader thread.
+        self.channels = channels
+        # With a runtime.EventLoop, polling runs as a timer on that loop
+        # instead of on a thread of its own.
+        self.runtime = runtime
+        self.snapshots = snapshots
+        self.sources = None
+        self.poller = None
+        self.loop = None
+        # Set to stop the reader thread; each run gets its own.
+        self.stopped = None
         self.registry.register('start diff loop', self.connect)
         self.registry.register('stop diff loop', self.disconnect)
 
+    def _create_sources(self):
+        if not self.channels:
+            return [ItemSource(
+                self.registry, None, self.transport, self.source,
+                self.debounce, self.capture, self.runtime, self.snapshots
+            )]
+        sources = []
+        for channel, transport in self.channels:
+            capture = None
+            if self.capture:
+                capture = '%s.%s' % (self.capture, channel)
+            sources.append(ItemSource(
+                self.registry, channel, transport, None, self.debounce,
+                capture, self.runtime, self.snapshots
+            ))
+        return sources
+
+    def _start(self):
+        self.registry.emit(
+            'log',
+            'Inventory state reading has begun. ' +\
+            'Please ensure that DiabloInterface ' +\
+            'is running, or data cannot be transmitted.'
+        )
+        if TRACING:
+            tracer.start('verbose.log')
+        self.scheduler = PollScheduler(self.poll_interval, **self.polling)
+        self.sources = self._create_sources()
+
+    def _poll(self):
+        # Returns how long to wait before the next round.
+        started = time.time()
+        active = False
+        for source in self.sources:
+            # A missing or broken instance must not hold up the others.
+            try:
+                active = source.poll() or active
+            except Exception as e:
+                tracer.event('error', source.channel, repr(e))
+                READ_ERRORS.inc()
+                if LOGGING:
+                    with open('error.log', 'a') as log:
+                        log.write(str(time.time()) + '\n')
+                        traceback.print_exc(file=log)
+            active = active or source.debouncer.settling()
+        return self.scheduler.next_delay(started, active)
+
+    def _stop(self):
+        for source in self.sources:
+            source.close()
+        self.sources = None
+        tracer.stop()
+        self.registry.emit('log', 'Exiting read loop...')
+
+    def _poll_round(self):
+        self.poller = self.runtime.call_later(self._poll(), self._poll_round)
+
+    # These run on the event loop, so they cannot race with _poll_round.
+
+    def _start_polling(self):
+        if self.sources is None:
+            self._start()
+            self._poll_round()
+
+    def _stop_polling(self):
+        if self.sources is not None:
+            self.poller.cancel()
+            self._stop()
+
     def connect(self):
-        self.keep_running = True
+        if self.runtime is not None:
+            self.runtime.call_soon_threadsafe(self._start_polling)
+            return
+
+        # Logging in again after an EBS reconnect must not start a second
+        # reader; the running one never stopped.
+        if self.loop is not None and self.loop.is_alive():
+            if not self.stopped.is_set():
+                return
+            # Stopped but still in its last round: let it close its sources
+            # before the new run creates them.
+            self.loop.join()
+        stopped = self.stopped = Event()
 
         def diff_loop():
-            self.registry.emit(
-                'log',
-                'Inventory state reading has begun. ' +\
-                'Please ensure that DiabloInterface ' +\
-                'is running, or data cannot be transmitted.'
-            )
-            err.add_line('Creating/clearing verbose log')
-            with open('verbose.log', 'w') as f:
-                pass
-            err.add_line('Starting IC.diff_loop')
-
-            pipe = PipeHandler(self.registry)
-            dirty_state = DirtyItemState(self.registry)
-            clean_state = CleanItemState(self.registry)
-
-            def update(item_set):
-                err.add_line('Starting item comparison')
-                err.timestamp()
-                dirty_state.diff(item_set)
-                return clean_state.diff(dirty_state)
-
-            while self.keep_running:
-                try:
-                    err.add_line('At beginning of diff loop try block')
-                    err.add_line('Calling pipe.get_items')
-                    err.timestamp()
-                    items    = pipe.get_items()
-                    err.timestamp()
-                    snapshot = update(items)
-                    err.timestamp()
-                    if snapshot is None:
-                        err.add_line('Got None as snapshot')
-                        err.timestamp()
-                        with open('verbose.log', 'a') as verbose:
-                            err.finish(verbose)
-                        continue
-                    else:
-                        err.add_line('Got Diff, escaping and sending')
-                        err.timestamp()
-                        escaped = json.dumps(json.dumps((time.time(), snapshot)))
-                        err.add_line('Escaped snapshot: ' + escaped)
-                        err.add_line('Emitting update signal')
-                        err.timestamp()
-                        self.registry.emit('update', escaped)
-                except Exception as e:
-                    err.add_line('An exception occurred')
-                    err.timestamp()
-                    if LOGGING:
-                        with open('error.log', 'a') as log:
-                            log.write(str(time.time()) + '\n')
-                            traceback.print_exc(file=log)
-                finally:
-                    with open('verbose.log', 'a') as verbose:
-                        err.finish(verbose)
-                    time.sleep(0.1)
-            self.registry.emit('log', 'Exiting read loop...')
+            self._start()
+            while not stopped.is_set():
+                time.sleep(self._poll())
+            self._stop()
 
         self.loop = Thread(target=diff_loop)
         self.loop.daemon = True
         self.loop.start()
 
     def disconnect(self):
-        self.keep_running = False
+        if self.stopped is not None:
+            self.stopped.set()
+        if self.runtime is not None:
+            self.runtime.call_soon_threadsafe(self._stop_polling)
@@ -0,0 +1,200 @@
+import sys
+import time
+import random
+import argparse
+from threading import Lock
+from signals import SignalRegistry
+from runtime import EventLoop
+from item_state import ItemState
+from headless import resident_memory
+from bench import full_gear
+from ebs_server import EBSServer, UPDATE_PATH
+import ebs
+
+CLIENTS = 200
+# Gear swaps per client per second; a streamer mid-fight swaps maybe once
+# a minute, so the default is a heavy day for the EBS.
+SWAP_RATE = 0.5
+DURATION = 30.0
+CONNECT_TIMEOUT = 30.0
+
+
+class SimulatedClient:
+
+    # One streamer: its own signals, item state and EBSConnection, fed by
+    # random gear swaps instead of DiabloInterface.
+
+    def __init__(self, index, url, delta, runtime, rate, rng, stats):
+        self.index = index
+        self.rate = rate
+        self.rng = rng
+        self.stats = stats
+        self.items = full_gear()
+        self.state = ItemState(None)
+        self.state.diff(self.items)
+        self.logged_in = False
+        self.generator = None
+
+        self.registry = SignalRegistry()
+        self.registry.register('logged in', self.on_logged_in)
+        self.registry.register('ebs reconnecting', self.on_reconnecting)
+        self.connection = ebs.EBSConnection(
+            self.registry, delta, runtime=runtime, url=url
+        )
+
+    def on_logged_in(self):
+        if not self.logged_in:
+            self.logged_in = True
+            self.stats.count('logged_in')
+            # The first snapshot goes out on login, like a real client.
+            self.connection.send_update(self.state.snapshot())
+
+    def on_reconnecting(self, delay):
+        self.stats.count('reconnects')
+
+    def connect(self):
+        self.connection.connect('loadtest%d' % self.index, 'key%d' % self.index)
+
+    def swap(self):
+        # Alternate one item between its own name and a renamed copy.
+        item = self.rng.choice(self.items)
+        name = item[u'ItemName']
+        if name.endswith(u' (swapped)'):
+            item[u'ItemName'] = name[:-len(u' (swapped)')]
+        else:
+            item[u'ItemName'] = name + u' (swapped)'
+        diff = self.state.diff(self.items)
+        diff.detected = time.time()
+        self.connection.send_update(self.state.snapshot(), diff)
+        self.stats.count('swaps')
+
+    def schedule(self, generator):
+        def tick():
+            if self.logged_in:
+                self.swap()
+            self.schedule(generator)
+        self.generator = generator.call_later(self.rng.expovariate(self.rate), tick)
+
+    def stop(self):
+        if self.generator is not None:
+            self.generator.cancel()
+        self.connection.disconnect()
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = {'logged_in': 0, 'reconnects': 0, 'swaps': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Drive an EBS with many simulated streamer clients.'
+    )
+    parser.add_argument('--clients', type=int, default=CLIENTS)
+    parser.add_argument(
+        '--rate', type=float, default=SWAP_RATE, help='gear swaps per client per second'
+    )
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds to run')
+    parser.add_argument(
+        '--url', help='EBS to load; by default a local ebs_server.EBSServer is started'
+    )
+    parser.add_argument('--delta', action='store_true', help='send delta updates')
+    parser.add_argument(
+        '--threads', action='store_true',
+        help='one websocket thread per client instead of a shared event loop'
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def wait_for(condition, timeout):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.05)
+    return condition()
+
+
+def main(argv):
+    args = parse_args(argv)
+    server = None
+    url = args.url
+    if url is None:
+        server = EBSServer(('127.0.0.1', 0)).start()
+        url = 'ws://%s:%d%s' % (server.address + (UPDATE_PATH,))
+
+    # Swaps are generated on their own loop so the clients' loop (or
+    # threads) only see what a real item reader would hand them.
+    generator = EventLoop().start()
+    runtime = None if args.threads else EventLoop().start()
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+
+    memory_before = resident_memory()
+    clients = [
+        SimulatedClient(
+            i, url, args.delta, runtime, args.rate, random.Random(rng.random()), stats
+        ) for i in xrange(args.clients)
+    ]
+    started = time.time()
+    for client in clients:
+        client.connect()
+    logged_in = wait_for(
+        lambda: stats.counts['logged_in'] >= args.clients, CONNECT_TIMEOUT
+    )
+    print '%d/%d clients logged in to %s in %.1f s (%s)' % (
+        stats.counts['logged_in'], args.clients, url, time.time() - started,
+        'threads' if args.threads else 'one event loop'
+    )
+    memory_after = resident_memory()
+
+    sent_before = ebs.UPDATES_SENT.value
+    received_before = server.stats() if server is not None else None
+    for client in clients:
+        client.schedule(generator)
+    time.sleep(args.duration)
+    for client in clients:
+        client.stop()
+    sent = ebs.UPDATES_SENT.value - sent_before
+    generator.stop()
+    wait_for(lambda: server is None or server.stats()['clients'] == 0, 5.0)
+
+    print '  %d swaps, %.0f messages/sec sent, %d send errors, %d reconnects' % (
+        stats.counts['swaps'], sent / args.duration,
+        ebs.SEND_ERRORS.value, stats.counts['reconnects']
+    )
+    change_to_send = ebs.CHANGE_TO_SEND
+    print '  client change-to-send: p50 %.1f ms, p99 %.1f ms' % (
+        change_to_send.quantile(0.5) * 1000, change_to_send.quantile(0.99) * 1000
+    )
+    if server is not None:
+        counts = server.stats()
+        latency = server.latency
+        print '  server received %.0f messages/sec, %.1f KB/sec, %d resyncs, %d rejected' % (
+            (counts['messages'] - received_before['messages']) / args.duration,
+            (counts['bytes'] - received_before['bytes']) / args.duration / 1024,
+            counts['resyncs'], counts['rejected']
+        )
+        print '  update-to-receipt: p50 %.1f ms, p99 %.1f ms, p99.9 %.1f ms' % (
+            latency.quantile(0.5) * 1000, latency.quantile(0.99) * 1000,
+            latency.quantile(0.999) * 1000
+        )
+        server.stop()
+    if memory_before is not None and memory_after is not None:
+        # Peak RSS, so this is an upper bound; with an in-process server
+        # its connection threads are included.
+        print '  %.1f MB resident, about %.0f KB per client' % (
+            memory_after, (memory_after - memory_before) * 1024 / max(1, args.clients)
+        )
+    if runtime is not None:
+        runtime.stop()
+    return 0 if logged_in else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
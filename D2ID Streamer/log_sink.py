@@ -0,0 +1,71 @@
+import time
+from collections import deque
+from ebs import PING_INTERVAL
+
+LOG_LINES = 500
+# Messages that can arrive often enough to drown out the rest of the log.
+# Everything else is always shown, repeats included.
+RATE_LIMITED = frozenset(['PONG!'])
+# Spans several pings, so a pong is shown about once in this long.
+REPEAT_WINDOW = PING_INTERVAL * 5
+
+
+class LogSink:
+
+    # Collects log messages from any thread for the GUI thread to pick up
+    # in batches. A rate limited message repeated within repeat_window is
+    # shown once; the repeats are summarised with a count when the window
+    # runs out.
+
+    def __init__(self, capacity=LOG_LINES, repeat_window=REPEAT_WINDOW,
+                 rate_limited=RATE_LIMITED, clock=time.time):
+        # deque appends and pops are atomic, so producers need no lock. If
+        # nobody drains, only the newest lines are kept.
+        self.queue = deque(maxlen=capacity)
+        self.repeat_window = repeat_window
+        self.rate_limited = rate_limited
+        self.clock = clock
+        self.last_shown = {}
+        self.suppressed = {}
+
+    def put(self, message, leading_newline=True):
+        self.queue.append((self.clock(), message, leading_newline))
+
+    def _limit(self, ts, message):
+        if message not in self.rate_limited:
+            return message
+        shown = self.last_shown.get(message)
+        if shown is not None and ts - shown < self.repeat_window:
+            self.suppressed[message] = self.suppressed.get(message, 0) + 1
+            return None
+        self.last_shown[message] = ts
+        repeats = self.suppressed.pop(message, 0)
+        if repeats:
+            return '%s (repeated %d more times)' % (message, repeats)
+        return message
+
+    def drain(self):
+        lines = []
+        queue = self.queue
+        while queue:
+            try:
+                ts, message, leading_newline = queue.popleft()
+            except IndexError:
+                break
+            message = self._limit(ts, message)
+            if message is not None:
+                lines.append((ts, message, leading_newline))
+        lines.extend(self._expire(self.clock()))
+        return lines
+
+    def _expire(self, now):
+        # Closes windows that ran out: their repeat counts are reported now
+        # rather than waiting for the message to come round again.
+        lines = []
+        for message, shown in self.last_shown.items():
+            if now - shown >= self.repeat_window:
+                del self.last_shown[message]
+                repeats = self.suppressed.pop(message, 0)
+                if repeats:
+                    lines.append((now, '%s (repeated %d more times)' % (message, repeats), True))
+        return lines
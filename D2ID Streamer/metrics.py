@@ -0,0 +1,235 @@
+import math
+import time
+import SocketServer
+import BaseHTTPServer
+from threading import Thread, Event, Lock
+
+METRICS_ADDRESS = ('127.0.0.1', 9464)
+SUMMARY_INTERVAL = 300.0
+# Histogram buckets per power of two: about 9% relative error on quantiles.
+SUB_BUCKETS = 8
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+    def summary(self):
+        return '%s=%d' % (self.name, self.value)
+
+
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read=None):
+        # A gauge either holds what was last set or asks read() on export,
+        # so a value kept elsewhere needs no extra bookkeeping.
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.read = read
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.read is not None:
+            return self.read()
+        return self.value
+
+    def samples(self):
+        return [(self.name, '', self.get())]
+
+    def summary(self):
+        return '%s=%g' % (self.name, self.get())
+
+
+class Histogram:
+
+    # Log-linear buckets in the style of HdrHistogram: each power of two is
+    # split into SUB_BUCKETS, so recording is one frexp and one dict update
+    # and the memory is bounded by the range of values seen.
+
+    kind = 'summary'
+
+    def __init__(self, name, help, sub_buckets=SUB_BUCKETS):
+        self.name = name
+        self.help = help
+        self.sub_buckets = sub_buckets
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.lock = Lock()
+
+    def _bucket(self, value):
+        if value <= 0:
+            return None
+        mantissa, exponent = math.frexp(value)
+        return exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+
+    def _upper(self, bucket):
+        exponent, sub = divmod(bucket, self.sub_buckets)
+        return math.ldexp(0.5 + (sub + 1) / (2.0 * self.sub_buckets), exponent)
+
+    def observe(self, value):
+        bucket = self._bucket(value)
+        with self.lock:
+            self.counts[bucket] = self.counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+
+    def time(self, started):
+        self.observe(time.time() - started)
+
+    def quantile(self, q):
+        with self.lock:
+            counts = sorted(self.counts.items())
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for bucket, n in counts:
+            seen += n
+            if seen >= rank:
+                return 0.0 if bucket is None else self._upper(bucket)
+        return self._upper(counts[-1][0])
+
+    def samples(self):
+        samples = [
+            (self.name, '{quantile="%g"}' % q, self.quantile(q)) for q in QUANTILES
+        ]
+        samples.append((self.name + '_sum', '', self.total))
+        samples.append((self.name + '_count', '', self.count))
+        return samples
+
+    def summary(self):
+        return '%s n=%d p50=%.1fms p99=%.1fms' % (
+            self.name, self.count, self.quantile(0.5) * 1000, self.quantile(0.99) * 1000
+        )
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+        self.names = {}
+
+    def _add(self, metric):
+        # Modules register at import time; asking again returns the same one.
+        existing = self.names.get(metric.name)
+        if existing is not None:
+            return existing
+        self.names[metric.name] = metric
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, read=None):
+        gauge = self._add(Gauge(name, help, read))
+        if read is not None:
+            gauge.read = read
+        return gauge
+
+    def histogram(self, name, help):
+        return self._add(Histogram(name, help))
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4.
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s\n' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s\n' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %r\n' % (name, labels, float(value)))
+        return ''.join(lines)
+
+    def summary(self):
+        return ', '.join(metric.summary() for metric in self.metrics)
+
+
+metrics = MetricsRegistry()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer:
+
+    def __init__(self, address=METRICS_ADDRESS, registry=metrics):
+        self.server = _HTTPServer(address, _Handler)
+        self.server.metrics = registry
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsReporter:
+
+    # Writes a one line summary of every metric to the client log.
+
+    def __init__(self, signals, interval=SUMMARY_INTERVAL, registry=metrics):
+        self.signals = signals
+        self.interval = interval
+        self.registry = registry
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.signals.emit('log', 'Metrics: ' + self.registry.summary())
+
+    def stop(self):
+        self.stopped.set()
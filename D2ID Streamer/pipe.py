@@ -0,0 +1,263 @@
+import json
+import time
+import socket
+from framing import FrameReader, encode_frame
+from tracing import tracer
+from metrics import metrics
+
+try:
+    import pywintypes
+    from win32file import (
+        CreateFile, ReadFile, WriteFile, CloseHandle,
+        GENERIC_READ, GENERIC_WRITE, OPEN_EXISTING
+    )
+    from win32pipe import WaitNamedPipe
+except ImportError:
+    # Not on Windows; only the socket transport is usable.
+    pywintypes = None
+
+PIPE_PREFIX = '\\\\.\\pipe\\'
+PIPE_NAME = PIPE_PREFIX + 'DiabloInterfaceItems'
+READ_CHUNK_SIZE = 65536
+
+PIPE_REQUESTS = metrics.counter('d2id_pipe_requests_total', 'Pipe transactions completed.')
+PIPE_BUSY = metrics.counter('d2id_pipe_busy_total', 'Retries after ERROR_PIPE_BUSY (231).')
+PIPE_NOT_FOUND = metrics.counter(
+    'd2id_pipe_not_found_total', 'Retries after ERROR_FILE_NOT_FOUND (2).'
+)
+PIPE_LOST = metrics.counter('d2id_pipe_lost_total', 'Pipe connections that went away.')
+PIPE_SECONDS = metrics.histogram(
+    'd2id_pipe_transaction_seconds', 'Pipe request to parsed response, retries included.'
+)
+
+ERROR_FILE_NOT_FOUND = 2
+ERROR_PIPE_BUSY = 231
+
+# First byte item_server.py sends on every connection, standing in for what
+# CreateFile reports when opening a real pipe.
+CONNECT_OK = 'K'
+CONNECT_BUSY = 'B'
+CONNECT_NOT_FOUND = 'N'
+
+
+def pipe_path(name):
+    # Takes DiabloInterface's ItemServerPipeName setting (a bare name) as
+    # well as a full \\.\pipe\ path.
+    if name.startswith('\\\\'):
+        return name
+    return PIPE_PREFIX + name
+
+
+class TransportError(Exception):
+    pass
+
+
+class PipeBusy(TransportError):
+    pass
+
+
+class PipeNotFound(TransportError):
+    pass
+
+
+class ConnectionLost(TransportError):
+    pass
+
+
+class Win32PipeTransport:
+
+    def __init__(self, pipe_name=PIPE_NAME, wait_timeout=1000):
+        self.pipe_name = pipe_name
+        self.wait_timeout = wait_timeout
+        self.handle = None
+
+    def open(self, wait=True):
+        try:
+            self.handle = CreateFile(
+                self.pipe_name,
+                GENERIC_READ|GENERIC_WRITE,
+                0,
+                None,
+                OPEN_EXISTING,
+                0,
+                None
+            )
+        except pywintypes.error as e:
+            if e[0] == ERROR_PIPE_BUSY:
+                if not wait:
+                    raise PipeBusy(str(e))
+                try:
+                    WaitNamedPipe(self.pipe_name, self.wait_timeout)
+                except pywintypes.error as wfpe:
+                    raise PipeNotFound(str(wfpe))
+                raise PipeBusy(str(e))
+            elif e[0] == ERROR_FILE_NOT_FOUND:
+                raise PipeNotFound(str(e))
+            raise
+
+    def write(self, data):
+        try:
+            WriteFile(self.handle, data)
+        except pywintypes.error as e:
+            raise ConnectionLost(str(e))
+
+    def read(self, size):
+        try:
+            data = ReadFile(self.handle, size)[1]
+        except pywintypes.error as e:
+            raise ConnectionLost(str(e))
+        if not data:
+            raise ConnectionLost('Pipe closed by server')
+        return data
+
+    def readinto(self, view):
+        # ReadFile cannot fill a memoryview slice, so each chunk is copied
+        # into place once; the chunk is as large as the rest of the frame.
+        data = self.read(min(len(view), READ_CHUNK_SIZE))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.handle is not None:
+            try:
+                CloseHandle(self.handle)
+            except pywintypes.error:
+                pass
+            self.handle = None
+
+
+class SocketTransport:
+
+    def __init__(self, address, timeout=5.0, busy_wait=0.05):
+        self.address = address
+        self.timeout = timeout
+        # How long a busy answer waits before PipeBusy, like WaitNamedPipe.
+        self.busy_wait = busy_wait
+        self.sock = None
+
+    def open(self, wait=True):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+            status = sock.recv(1)
+        except socket.error as e:
+            sock.close()
+            raise PipeNotFound(str(e))
+        if status != CONNECT_OK:
+            sock.close()
+            if status == CONNECT_BUSY:
+                if wait:
+                    time.sleep(self.busy_wait)
+                raise PipeBusy('%r has no free instance' % (self.address,))
+            raise PipeNotFound('%r refused the connection' % (self.address,))
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def write(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            raise ConnectionLost(str(e))
+
+    def read(self, size):
+        try:
+            data = self.sock.recv(size)
+        except socket.error as e:
+            raise ConnectionLost(str(e))
+        if not data:
+            raise ConnectionLost('Socket closed by server')
+        return data
+
+    def readinto(self, view):
+        try:
+            size = self.sock.recv_into(view)
+        except socket.error as e:
+            raise ConnectionLost(str(e))
+        if not size:
+            raise ConnectionLost('Socket closed by server')
+        return size
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class PipeSession:
+
+    def __init__(self, transport, max_retries=10, retry_delay=0.1, wait=True):
+        self.transport = transport
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Whether opening a busy pipe waits for an instance to free up.
+        # With max_retries=0 and no wait, a transaction never sleeps: an
+        # event loop caller retries on its next round instead.
+        self.wait = wait
+        self.connected = False
+        self.connects = 0
+        self.requests = 0
+        self.frames = FrameReader(transport)
+
+    def _construct_query(self, json_dict):
+        return encode_frame(json.dumps(json_dict, encoding='utf-8'))
+
+    def _connect(self):
+        with tracer.span('pipe.connect'):
+            self.transport.open(self.wait)
+        self.connected = True
+        self.connects += 1
+
+    def transact(self, query):
+        started = time.time()
+        packet = self._construct_query(query)
+        retries = 0
+
+        while True:
+            reused = self.connected
+            try:
+                if not self.connected:
+                    self._connect()
+                with tracer.span('pipe.write'):
+                    self.transport.write(packet)
+                with tracer.span('pipe.read'):
+                    payload = self.frames.read_frame()
+            except PipeBusy:
+                tracer.event('pipe.busy', retries)
+                PIPE_BUSY.inc()
+                # The transport has already blocked waiting for the pipe.
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+            except PipeNotFound:
+                tracer.event('pipe.not_found', retries)
+                PIPE_NOT_FOUND.inc()
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                time.sleep(self.retry_delay)
+            except ConnectionLost:
+                tracer.event('pipe.lost', reused)
+                PIPE_LOST.inc()
+                self.close()
+                # A held handle going stale is expected (the server may have
+                # dropped an idle client), so reconnect straight away once.
+                if not reused:
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise
+                    time.sleep(self.retry_delay)
+            else:
+                self.requests += 1
+                with tracer.span('pipe.parse'):
+                    # The one copy left: json only parses str.
+                    response = json.loads(payload.tobytes(), encoding='utf-8')
+                PIPE_REQUESTS.inc()
+                PIPE_SECONDS.time(started)
+                return response
+
+    def close(self):
+        self.transport.close()
+        self.connected = False
@@ -0,0 +1,169 @@
+import time
+import heapq
+import socket
+import select
+import traceback
+from collections import deque
+from threading import Thread, Lock, current_thread
+
+
+class Handle(object):
+    __slots__ = ('callback', 'args', 'cancelled')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            self.callback(*self.args)
+
+
+def _socketpair():
+    # Windows Python 2 has no socket.socketpair, and select() there only
+    # takes sockets, so the waker is a loopback TCP pair.
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    writer.connect(listener.getsockname())
+    reader = listener.accept()[0]
+    listener.close()
+    writer.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return writer, reader
+
+
+class EventLoop:
+
+    # A single threaded select() reactor: callbacks, timers and socket
+    # readers all run on the loop thread, one at a time. Other threads hand
+    # work over with call_soon_threadsafe().
+
+    def __init__(self):
+        self.ready = deque()
+        self.timers = []
+        self.readers = {}
+        self.seq = 0
+        self.lock = Lock()
+        self.running = False
+        self.thread = None
+        self.waker, self.wakee = _socketpair()
+        self.wakee.setblocking(0)
+        self.add_reader(self.wakee, self._drain_waker)
+
+    def in_loop(self):
+        return current_thread() is self.thread
+
+    def _wake(self):
+        if not self.in_loop():
+            try:
+                self.waker.send('x')
+            except socket.error:
+                pass
+
+    def _drain_waker(self):
+        try:
+            while self.wakee.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args)
+        with self.lock:
+            self.ready.append(handle)
+        self._wake()
+        return handle
+
+    call_soon_threadsafe = call_soon
+
+    def call_later(self, delay, callback, *args):
+        handle = Handle(callback, args)
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.seq, handle))
+        self._wake()
+        return handle
+
+    def add_reader(self, sock, callback, *args):
+        self.readers[sock.fileno()] = (sock, Handle(callback, args))
+
+    def remove_reader(self, sock):
+        # By identity, since a socket that is already closed has no fileno.
+        for fd, (registered, handle) in self.readers.items():
+            if registered is sock:
+                del self.readers[fd]
+
+    def _drop_bad_readers(self):
+        # A reader whose socket was closed without remove_reader() would
+        # make every select() fail; drop it rather than lose the loop.
+        for fd, (sock, handle) in self.readers.items():
+            try:
+                select.select([sock], [], [], 0)
+            except (select.error, socket.error, ValueError):
+                traceback.print_exc()
+                del self.readers[fd]
+
+    def _timeout(self):
+        if self.ready:
+            return 0
+        if self.timers:
+            return max(0, self.timers[0][0] - time.time())
+        return None
+
+    def run_once(self):
+        with self.lock:
+            timeout = self._timeout()
+        sockets = [sock for sock, handle in self.readers.values()]
+        try:
+            readable = select.select(sockets, [], [], timeout)[0]
+        except (select.error, socket.error, ValueError):
+            self._drop_bad_readers()
+            return
+        for sock in readable:
+            entry = self.readers.get(sock.fileno())
+            if entry is not None:
+                self._run(entry[1])
+
+        with self.lock:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                self.ready.append(heapq.heappop(self.timers)[2])
+            # Anything scheduled by these callbacks waits for the next pass,
+            # so a callback that reschedules itself cannot starve the loop.
+            batch = list(self.ready)
+            self.ready.clear()
+        for handle in batch:
+            self._run(handle)
+
+    def _run(self, handle):
+        try:
+            handle.run()
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        self.thread = current_thread()
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def start(self):
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Everything already scheduled runs first; pending timers are dropped.
+        def halt():
+            self.running = False
+        self.call_soon_threadsafe(halt)
+        if self.thread is not None and not self.in_loop():
+            self.thread.join()
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import argparse
+from pipe import PIPE_NAME, TransportError, PipeNotFound
+from tracing import tracer
+from metrics import metrics
+
+# Shared memory layout, written by DiabloInterface's Server/SnapshotWriter.cs:
+# magic, layout version, sequence (odd while a write is in progress),
+# generation, payload length, heartbeat, reserved; then the UTF-8 JSON
+# response to an "all" item query.
+MAGIC = 'D2IDSNP1'
+LAYOUT_VERSION = 1
+HEADER = struct.Struct('<8sIIiIII')
+UINT32 = struct.Struct('<I')
+SEQUENCE_OFFSET = 12
+HEARTBEAT_OFFSET = 24
+REGION_SIZE = 65536
+
+# Where regions live off Windows, where the stand-in writer is used.
+SNAPSHOT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+READ_RETRIES = 1000
+# A writer bumps the heartbeat every 100 ms; one that stopped for this long
+# has gone away and left the region behind.
+STALE_AFTER = 2.0
+# How often to look for snapshots again while reading over the pipe.
+RETRY_INTERVAL = 5.0
+HEARTBEAT_INTERVAL = 0.1
+
+SNAPSHOT_READS = metrics.counter('d2id_snapshot_reads_total', 'Item sets read from shared memory.')
+SNAPSHOT_RETRIES = metrics.counter(
+    'd2id_snapshot_retries_total', 'Shared memory reads retried because a write was in progress.'
+)
+
+
+class SnapshotBusy(TransportError):
+    pass
+
+
+def snapshot_name(transport=None):
+    # DiabloInterface names the region after its pipe.
+    pipe_name = getattr(transport, 'pipe_name', PIPE_NAME)
+    return pipe_name.rsplit('\\', 1)[-1]
+
+
+def region_path(name):
+    if os.path.isabs(name):
+        return name
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+def open_region(name, size=REGION_SIZE, write=False):
+    if sys.platform == 'win32':
+        # Opens DiabloInterface's mapping, or creates an empty one it will
+        # open in turn; no magic means nothing was published yet.
+        return mmap.mmap(-1, size, tagname=name)
+    path = region_path(name)
+    if write:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        access = mmap.ACCESS_WRITE
+    else:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            raise PipeNotFound(str(e))
+        size = os.fstat(fd).st_size
+        access = mmap.ACCESS_READ
+    try:
+        if size < HEADER.size:
+            raise PipeNotFound('%s is not a snapshot region' % path)
+        return mmap.mmap(fd, size, access=access)
+    finally:
+        os.close(fd)
+
+
+class SnapshotReader:
+
+    # Seqlock reader: copy the payload between two reads of the sequence
+    # and retry if a write was in progress or completed meanwhile. Reads
+    # never block the writer and need no request to DiabloInterface.
+
+    def __init__(self, name, retries=READ_RETRIES):
+        self.name = name
+        self.retries = retries
+        self.region = None
+        self.heartbeat = None
+        self.beat_at = 0
+
+    def open(self):
+        self.region = open_region(self.name)
+        self.heartbeat = None
+
+    def _sequence(self):
+        return UINT32.unpack_from(self.region, SEQUENCE_OFFSET)[0]
+
+    def live(self):
+        # Published by the current layout and still being kept up to date.
+        magic, version, sequence, generation, length, heartbeat, _ = \
+            HEADER.unpack_from(self.region, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            return False
+        now = time.time()
+        if heartbeat != self.heartbeat:
+            self.heartbeat = heartbeat
+            self.beat_at = now
+        return now - self.beat_at < STALE_AFTER
+
+    def read(self, payload=True):
+        # Returns (generation, payload), consistent with each other.
+        region = self.region
+        limit = len(region) - HEADER.size
+        for _ in xrange(self.retries):
+            sequence = self._sequence()
+            if not sequence & 1:
+                magic, version, _, generation, length, _, _ = HEADER.unpack_from(region, 0)
+                if magic != MAGIC:
+                    raise PipeNotFound('No item snapshots published in %s' % self.name)
+                data = None
+                if payload and length <= limit:
+                    data = region[HEADER.size:HEADER.size + length]
+                if self._sequence() == sequence and length <= limit:
+                    return generation, data
+            SNAPSHOT_RETRIES.inc()
+            time.sleep(0)
+        raise SnapshotBusy('Item snapshot kept changing during %d reads' % self.retries)
+
+    def close(self):
+        if self.region is not None:
+            self.region.close()
+            self.region = None
+
+
+class SnapshotSource:
+
+    # Same interface as PipeHandler for ItemSource. Reads DiabloInterface's
+    # shared memory snapshots while it publishes them, and the pipe
+    # (fallback) otherwise: older builds, snapshots turned off in its
+    # settings, or a DiabloInterface that quit.
+
+    def __init__(self, registry, name, fallback):
+        self.registry = registry
+        self.reader = SnapshotReader(name)
+        self.fallback = fallback
+        self.active = False
+        self.checked = 0
+
+    def _available(self):
+        now = time.time()
+        if not self.active and now - self.checked < RETRY_INTERVAL:
+            return False
+        self.checked = now
+        if self.reader.region is None:
+            try:
+                self.reader.open()
+            except (PipeNotFound, EnvironmentError, mmap.error):
+                return False
+        live = self.reader.live()
+        if live != self.active:
+            self.active = live
+            if live:
+                # DiabloInterface serves one pipe client at a time; let go.
+                self.fallback.close()
+                message = 'Reading items from DiabloInterface shared memory.'
+            else:
+                message = 'DiabloInterface stopped publishing item snapshots, ' +\
+                    'reading items over the pipe.'
+            self.registry.emit('log', message)
+        return live
+
+    def get_generation(self):
+        if self._available():
+            return self.reader.read(False)[0]
+        return self.fallback.get_generation()
+
+    def get_items(self, slots=None):
+        if slots is not None or not self.active:
+            return self.fallback.get_items(slots)
+        with tracer.span('snapshot.read'):
+            generation, payload = self.reader.read()
+        with tracer.span('snapshot.parse'):
+            items = json.loads(payload, encoding='utf-8')[u'Items']
+        SNAPSHOT_READS.inc()
+        return items
+
+    def close(self):
+        self.reader.close()
+        self.fallback.close()
+
+
+class SnapshotWriter:
+
+    # Pure Python counterpart of DiabloInterface's writer, for the item
+    # server stand-in and for testing off Windows.
+
+    def __init__(self, name, size=REGION_SIZE):
+        self.region = open_region(name, size, write=True)
+        self.sequence = UINT32.unpack_from(self.region, SEQUENCE_OFFSET)[0]
+        self.sequence += self.sequence & 1
+        self.heartbeat = 0
+
+    def write(self, generation, items):
+        payload = json.dumps(
+            {u'IsValid': True, u'Success': len(items) > 0, u'Generation': generation,
+             u'Items': items},
+            encoding='utf-8'
+        )
+        if len(payload) > len(self.region) - HEADER.size:
+            raise ValueError('Item snapshot does not fit the shared memory region')
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        UINT32.pack_into(self.region, SEQUENCE_OFFSET, self.sequence)
+        self.region[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(
+            self.region, 0, MAGIC, LAYOUT_VERSION, self.sequence, generation,
+            len(payload), self.heartbeat, 0
+        )
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        UINT32.pack_into(self.region, SEQUENCE_OFFSET, self.sequence)
+
+    def beat(self):
+        self.heartbeat = (self.heartbeat + 1) & 0xFFFFFFFF
+        UINT32.pack_into(self.region, HEARTBEAT_OFFSET, self.heartbeat)
+
+    def close(self):
+        self.region.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show an item snapshot region.')
+    parser.add_argument('name', nargs='?', default=snapshot_name())
+    args = parser.parse_args()
+
+    reader = SnapshotReader(args.name)
+    reader.open()
+    magic, version, sequence, generation, length, heartbeat, _ = \
+        HEADER.unpack_from(reader.region, 0)
+    print '%s: magic %r, layout %d, sequence %d, heartbeat %d' % (
+        args.name, magic, version, sequence, heartbeat
+    )
+    generation, payload = reader.read()
+    items = json.loads(payload, encoding='utf-8')[u'Items']
+    print 'generation %d, %d bytes, %d items' % (generation, len(payload), len(items))
+    for item in items:
+        print '  %2d %s' % (item[u'Location'], item[u'ItemName'])
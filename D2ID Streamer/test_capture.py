@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from capture import CaptureWriter, CaptureReader, ReplaySource, RECORD_HEADER
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'capture.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _items(self, i):
+        return [{u'ItemName': u'Item %d' % i, u'Location': 1}]
+
+    def test_resume_after_torn_record(self):
+        writer = CaptureWriter(self.path)
+        for i in xrange(3):
+            writer.record(self._items(i), ts=i)
+        # A crash in the middle of writing the next record.
+        writer.file.write(RECORD_HEADER.pack(3, 100)[:7])
+        writer.close()
+
+        writer = CaptureWriter(self.path)
+        for i in xrange(3, 6):
+            writer.record(self._items(i), ts=i)
+        writer.close()
+
+        reader = CaptureReader(self.path)
+        self.assertEqual([items for _, items in reader], [self._items(i) for i in xrange(6)])
+        reader.close()
+
+    def test_replay_skips_damaged_record(self):
+        writer = CaptureWriter(self.path)
+        writer.record(self._items(0), ts=0)
+        writer.file.write(RECORD_HEADER.pack(0, 4) + 'junk')
+        writer.record(self._items(2), ts=0)
+        writer.close()
+
+        reader = CaptureReader(self.path)
+        source = ReplaySource(reader)
+        self.assertEqual(source.get_items(), self._items(0))
+        self.assertEqual(source.get_items(), self._items(2))
+        self.assertTrue(source.finished())
+        self.assertEqual(source.get_items(), self._items(2))
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import time
+import socket
+import unittest
+import ebs
+from signals import SignalRegistry
+from runtime import EventLoop
+from ebs_server import EBSServer, UPDATE_PATH
+from ebs import SendQueue
+
+TIMEOUT = 5.0
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.02)
+    return condition()
+
+
+class ReconnectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EBSServer(('127.0.0.1', 0)).start()
+        self.url = 'ws://%s:%d%s' % (self.server.address + (UPDATE_PATH,))
+        self.runtime = None
+
+    def tearDown(self):
+        self.server.stop()
+        if self.runtime is not None:
+            self.runtime.stop()
+
+    def _reconnect_after_kick(self, runtime):
+        registry = SignalRegistry()
+        logins = []
+        registry.register('logged in', lambda: logins.append(time.time()))
+        connection = ebs.EBSConnection(registry, runtime=runtime, url=self.url)
+        connection.backoff.base = 0.05
+        connection.connect('user', 'key')
+        self.assertTrue(wait_for(lambda: len(logins) == 1))
+
+        self.server.kick()
+        self.assertTrue(wait_for(lambda: len(logins) == 2), 'no reconnect after a server drop')
+        connection.send_update({1: None})
+        self.assertTrue(wait_for(lambda: self.server.stats()['messages'] >= 1))
+        connection.disconnect()
+
+    def test_threads(self):
+        self._reconnect_after_kick(None)
+
+    def test_event_loop(self):
+        self.runtime = EventLoop().start()
+        self._reconnect_after_kick(self.runtime)
+        self.assertTrue(self.runtime.thread.is_alive())
+
+
+class SendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.queue = SendQueue(
+            lambda channel, snapshot, diff: self.sent.append((channel, snapshot, diff)),
+            maxsize=4
+        )
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_full_queue_collapses_to_keyframes(self):
+        # Closed, as before login, so everything stays queued.
+        for i in xrange(4):
+            self.queue.put({1: i}, 'diff %d' % i, 'a' if i % 2 else 'b')
+        self.queue.put({1: 4}, 'diff 4', 'a')
+        self.assertEqual(
+            sorted(self.queue.pending), [('a', {1: 4}, None), ('b', {1: 2}, None)]
+        )
+        self.assertEqual(self.queue.dropped, 3)
+
+    def test_resume_replaces_pending(self):
+        self.queue.put({1: 'old'}, 'diff', 'a')
+        self.queue.put({1: 'old'}, 'diff', 'b')
+        # As on SUCCESS: the latest snapshot of every channel, nothing else.
+        self.queue.resume({'a': {1: 'new'}})
+        self.assertTrue(wait_for(lambda: self.sent))
+        time.sleep(0.05)
+        self.assertEqual(self.sent, [('a', {1: 'new'}, None)])
+        self.assertEqual(len(self.queue.pending), 0)
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def test_closed_reader_is_dropped(self):
+        runtime = EventLoop().start()
+        a, b = socket.socketpair()
+        runtime.call_soon_threadsafe(runtime.add_reader, a, lambda: None)
+        time.sleep(0.05)
+        # Closed without remove_reader(): select() on it fails from now on.
+        a.close()
+        done = []
+        runtime.call_later(0.05, done.append, True)
+        self.assertTrue(wait_for(lambda: done))
+        self.assertTrue(runtime.thread.is_alive())
+        runtime.stop()
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+from bisect import bisect_right
+from history import GearHistory, CHANGE_TAG, CHANGE_RECORD
+from item_state import ItemState, EQUIPMENT_SLOTS, SLOT_COUNT
+from bench import full_gear
+
+
+def names(gear):
+    return [gear[slot] and gear[slot][u'ItemName'] for slot in EQUIPMENT_SLOTS]
+
+
+class GearHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history.bin')
+        self.rng = random.Random(3)
+        self.gear = full_gear()
+        self.state = ItemState(None)
+        self.now = 1000.0
+        # (ts, snapshot) after every recorded change, to replay against.
+        self.truth = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _play(self, histories, changes):
+        # Random renames and removals, recorded in every history.
+        for _ in xrange(changes):
+            items = copy.deepcopy(self.gear)
+            i = self.rng.randrange(len(items))
+            if self.rng.random() < 0.1:
+                del items[i]
+            else:
+                items[i][u'ItemName'] = u'Variant %d' % self.rng.randrange(40)
+            diff = self.state.diff(items)
+            if diff.length():
+                for history in histories:
+                    history.record(diff, self.now)
+                self.truth.append((self.now, self.state.snapshot()))
+            self.now += self.rng.uniform(0.1, 4.0)
+
+    def _expected(self, ts):
+        times = [entry[0] for entry in self.truth]
+        k = bisect_right(times, ts)
+        return names(self.truth[k - 1][1]) if k else None
+
+    def test_at_matches_replay(self):
+        full = GearHistory(max_changes=1 << 30)
+        bounded = GearHistory(checkpoint_every=64, max_changes=1024)
+        self._play([full, bounded], 5000)
+        self.assertTrue(bounded.dropped)
+
+        first, last = self.truth[0][0], self.truth[-1][0]
+        for _ in xrange(3000):
+            ts = self.rng.uniform(first - 10, last + 10)
+            expected = self._expected(ts)
+            gear = full.at(ts)
+            self.assertEqual(gear and names(gear), expected)
+            # Holds from the oldest change still in memory on.
+            gear = bounded.at(ts)
+            if gear is not None:
+                self.assertEqual(names(gear), expected)
+
+    def test_load(self):
+        history = GearHistory(self.path)
+        self._play([history], 500)
+        history.close()
+        loaded = GearHistory.load(self.path)
+        self.assertEqual(len(loaded), len(history))
+        for ts, snapshot in self.truth[::50]:
+            self.assertEqual(names(loaded.at(ts)), names(snapshot))
+
+    def test_resume_after_truncated_record(self):
+        history = GearHistory(self.path)
+        self._play([history], 200)
+        history.close()
+        # A crash in the middle of writing the last change.
+        with open(self.path, 'ab') as f:
+            f.write(CHANGE_TAG + CHANGE_RECORD.pack(self.now, 1, 1)[:5])
+
+        resumed = GearHistory(self.path)
+        self.assertEqual(len(resumed), len(history))
+        self._play([resumed], 200)
+        resumed.close()
+
+        loaded = GearHistory.load(self.path)
+        self.assertEqual(len(loaded), len(resumed))
+        for ts, snapshot in self.truth[::20]:
+            self.assertEqual(names(loaded.at(ts)), names(snapshot))
+
+    def test_bad_slot_ends_load(self):
+        history = GearHistory(self.path)
+        self._play([history], 50)
+        history.close()
+        with open(self.path, 'ab') as f:
+            f.write(CHANGE_TAG + CHANGE_RECORD.pack(self.now, SLOT_COUNT, 0))
+        loaded = GearHistory.load(self.path)
+        self.assertEqual(len(loaded), len(history))
+
+
+if __name__ == '__main__':
+    unittest.main()
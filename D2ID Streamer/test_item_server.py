@@ -0,0 +1,46 @@
+import copy
+import unittest
+from signals import SignalRegistry
+from pipe import SocketTransport
+from item_state import PipeHandler
+from item_server import ItemServer, RING_LEFT, RING_RIGHT, PRIMARY_LEFT, PRIMARY_RIGHT
+from bench import full_gear
+
+
+def moved(items, first, second):
+    # The same items with the ones at first and second trading places.
+    items = copy.deepcopy(items)
+    for item in items:
+        if item[u'Location'] == first:
+            item[u'Location'] = second
+        elif item[u'Location'] == second:
+            item[u'Location'] = first
+    return items
+
+
+class GenerationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.items = full_gear()
+        self.server = ItemServer(('127.0.0.1', 0), self.items).start()
+        self.pipe = PipeHandler(SignalRegistry(), SocketTransport(self.server.address))
+
+    def tearDown(self):
+        self.pipe.close()
+        self.server.stop()
+
+    def test_swap_bumps_generation(self):
+        for first, second in ((RING_LEFT, RING_RIGHT), (PRIMARY_LEFT, PRIMARY_RIGHT)):
+            before = self.pipe.get_generation()
+            self.items = moved(self.items, first, second)
+            self.server.set_items(self.items)
+            self.assertNotEqual(self.pipe.get_generation(), before)
+
+    def test_same_items_keep_generation(self):
+        before = self.pipe.get_generation()
+        self.server.set_items(copy.deepcopy(self.items))
+        self.assertEqual(self.pipe.get_generation(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
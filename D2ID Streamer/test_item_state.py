@@ -0,0 +1,236 @@
+import os
+import copy
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import item_state
+from signals import SignalRegistry
+from runtime import EventLoop, Handle
+from pipe import SocketTransport
+from item_state import InventoryComparator, Debouncer, load_channels
+from item_server import ItemServer
+from bench import full_gear
+
+
+def unused_address():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class ManualLoop:
+
+    # Stands in for runtime.EventLoop with its own clock: timers only run
+    # when advance() moves the clock past them.
+
+    def __init__(self):
+        self.now = 1000.0
+        self.timers = []
+
+    def clock(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = Handle(callback, args)
+        self.timers.append((self.now + delay, handle))
+        return handle
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [timer for timer in self.timers if timer[0] <= end]
+            if not due:
+                break
+            timer = min(due, key=lambda timer: timer[0])
+            self.timers.remove(timer)
+            self.now = max(self.now, timer[0])
+            timer[1].run()
+        self.now = end
+
+
+class DebouncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ManualLoop()
+        self.gear = full_gear()
+        self.flushes = []
+
+    def _debouncer(self, **kwargs):
+        debouncer = Debouncer(
+            None, lambda snapshot, diff: self.flushes.append((self.loop.now, diff)),
+            quiet_period=0.5, max_latency=2.0, runtime=self.loop, clock=self.loop.clock,
+            **kwargs
+        )
+        # Settle on the starting gear first.
+        debouncer.feed(self.gear)
+        self.loop.advance(5.0)
+        del self.flushes[:]
+        return debouncer
+
+    def _change(self, debouncer, slot):
+        self.gear = copy.deepcopy(self.gear)
+        item = self.gear[slot]
+        item[u'ItemName'] += u'+'
+        self.assertTrue(debouncer.feed(self.gear))
+
+    def test_flush_after_quiet_period(self):
+        debouncer = self._debouncer()
+        started = self.loop.now
+        self._change(debouncer, 0)
+        self.loop.advance(0.4)
+        self._change(debouncer, 1)
+        self.loop.advance(0.4)
+        self.assertEqual(self.flushes, [])
+        self.loop.advance(0.2)
+        self.assertEqual(len(self.flushes), 1)
+        flushed, diff = self.flushes[0]
+        self.assertAlmostEqual(flushed, started + 0.9)
+        self.assertEqual(diff.detected, started)
+        self.assertEqual(len(diff.added), 2)
+
+    def test_max_latency_flushes_a_busy_burst(self):
+        debouncer = self._debouncer()
+        started = self.loop.now
+        for i in xrange(8):
+            self._change(debouncer, i % 3)
+            self.loop.advance(0.3)
+        self.assertEqual(len(self.flushes), 1)
+        self.assertAlmostEqual(self.flushes[0][0], started + 2.0)
+
+    def test_unchanged_items_are_not_a_change(self):
+        debouncer = self._debouncer()
+        self.assertFalse(debouncer.feed(copy.deepcopy(self.gear)))
+        self.assertFalse(debouncer.settling())
+
+    def test_leading_edge_only(self):
+        debouncer = self._debouncer(leading=True, trailing=False)
+        started = self.loop.now
+        self._change(debouncer, 0)
+        self.assertEqual([flushed for flushed, _ in self.flushes], [started])
+        # Within the quiet period: held, and dropped without a trailing edge.
+        self.loop.advance(0.2)
+        self._change(debouncer, 1)
+        self.loop.advance(5.0)
+        self.assertEqual(len(self.flushes), 1)
+        # The next leading edge publishes it along with the new change.
+        self._change(debouncer, 2)
+        self.assertEqual(len(self.flushes), 2)
+        self.assertEqual(len(self.flushes[1][1].added), 2)
+
+    def test_leading_and_trailing(self):
+        debouncer = self._debouncer(leading=True, trailing=True)
+        started = self.loop.now
+        self._change(debouncer, 0)
+        self.loop.advance(0.2)
+        self._change(debouncer, 1)
+        self.loop.advance(5.0)
+        self.assertEqual(
+            [round(flushed - started, 6) for flushed, _ in self.flushes], [0, 0.7]
+        )
+
+    def test_needs_an_edge(self):
+        self.assertRaises(
+            ValueError, Debouncer, None, None, leading=False, trailing=False
+        )
+
+
+class EventLoopPollingTest(unittest.TestCase):
+
+    def setUp(self):
+        item_state.LOGGING = False
+        self.runtime = EventLoop().start()
+        self.server = None
+
+    def tearDown(self):
+        self.runtime.stop()
+        item_state.LOGGING = True
+        if self.server is not None:
+            self.server.stop()
+
+    def _ticks(self, address, seconds=1.0, interval=0.05):
+        # Timer ticks the loop manages while a comparator polls address.
+        comparator = InventoryComparator(
+            SignalRegistry(), SocketTransport(address), capture=None, runtime=self.runtime
+        )
+        ticks = []
+
+        def tick():
+            ticks.append(time.time())
+            self.runtime.call_later(interval, tick)
+        comparator.connect()
+        self.runtime.call_soon_threadsafe(tick)
+        time.sleep(seconds)
+        comparator.disconnect()
+        return len(ticks)
+
+    def test_missing_pipe_does_not_block_loop(self):
+        self.assertGreater(self._ticks(unused_address()), 15)
+
+    def test_busy_pipe_does_not_block_loop(self):
+        self.server = ItemServer(('127.0.0.1', 0), full_gear(), single_client=True).start()
+        holder = SocketTransport(self.server.address)
+        holder.open()
+        try:
+            self.assertGreater(self._ticks(self.server.address), 15)
+        finally:
+            holder.close()
+        self.assertGreater(self.server.busy, 0)
+
+
+class ThreadPollingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ItemServer(('127.0.0.1', 0), full_gear()).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_quick_restart_runs_one_reader(self):
+        comparator = InventoryComparator(
+            SignalRegistry(), SocketTransport(self.server.address), capture=None,
+            polling={'idle_after': 0, 'max_interval': 1.0}
+        )
+        comparator.connect()
+        time.sleep(0.3)
+        first = comparator.loop
+        # Within one poll sleep, so the first reader has not seen the stop.
+        comparator.disconnect()
+        comparator.connect()
+        time.sleep(0.3)
+        self.assertFalse(first.is_alive())
+        self.assertTrue(comparator.loop.is_alive())
+        self.assertEqual(len(self.server.clients), 1)
+        comparator.disconnect()
+        comparator.loop.join()
+
+
+class LoadChannelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'channels')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_malformed_lines_skipped(self):
+        with open(self.path, 'w') as conf:
+            conf.write('# channel pipe\n\nfirst ItemsOne\nbroken\n  \nsecond \\\\.\\pipe\\ItemsTwo\n')
+        registry = SignalRegistry()
+        logged = []
+        registry.register('log', logged.append)
+        channels = load_channels(self.path, registry)
+        self.assertEqual(
+            [(channel, transport.pipe_name) for channel, transport in channels],
+            [('first', '\\\\.\\pipe\\ItemsOne'), ('second', '\\\\.\\pipe\\ItemsTwo')]
+        )
+        self.assertEqual(len(logged), 1)
+        self.assertIn('line 4', logged[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from ebs import PING_INTERVAL
+from log_sink import LogSink
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LogSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sink = LogSink(clock=self.clock)
+
+    def _messages(self):
+        return [message for _, message, _ in self.sink.drain()]
+
+    def test_pongs_at_ping_interval_are_limited(self):
+        self.sink.put('PONG!')
+        self.assertEqual(self._messages(), ['PONG!'])
+        for _ in xrange(3):
+            self.clock.now += PING_INTERVAL
+            self.sink.put('PONG!')
+            self.assertEqual(self._messages(), [])
+
+    def test_repeats_reported_when_window_expires(self):
+        self.sink.put('PONG!')
+        self.clock.now += PING_INTERVAL
+        self.sink.put('PONG!')
+        self._messages()
+        self.clock.now += self.sink.repeat_window
+        self.assertEqual(self._messages(), ['PONG! (repeated 1 more times)'])
+        self.assertEqual(self._messages(), [])
+
+    def test_other_messages_always_shown(self):
+        for _ in xrange(3):
+            self.sink.put('Connection to EBS lost.')
+        self.assertEqual(self._messages(), ['Connection to EBS lost.'] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import sys
+import time
+import random
+from collections import deque
+from threading import Thread, Event, Lock
+
+TRACE_CAPACITY = 8192
+FLUSH_INTERVAL = 1.0
+STAGE_SAMPLES = 4096
+
+# time.clock is the high resolution wall clock on Windows only.
+if sys.platform == 'win32':
+    clock = time.clock
+else:
+    clock = time.time
+
+
+class _Span(object):
+    __slots__ = ('ring', 'name', 'start')
+
+    def __init__(self, ring, name):
+        self.ring = ring
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.ring.append((time.time(), self.name, clock() - self.start, None))
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class StageStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        # Reservoir sample, so percentiles stay cheap over long sessions.
+        if len(self.samples) < STAGE_SAMPLES:
+            self.samples.append(duration)
+        else:
+            i = random.randrange(self.count)
+            if i < STAGE_SAMPLES:
+                self.samples[i] = duration
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+class Tracer:
+
+    def __init__(self, capacity=TRACE_CAPACITY, flush_interval=FLUSH_INTERVAL):
+        self.enabled = False
+        self.ring = deque(maxlen=capacity)
+        self.flush_interval = flush_interval
+        self.stats = {}
+        self.path = None
+        self.lock = Lock()
+        self.wake = Event()
+        self.thread = None
+
+    def span(self, name):
+        # Disabled tracing costs one attribute check and a shared no-op span.
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self.ring, name)
+
+    def event(self, name, *args):
+        # Arguments are only formatted by the flush thread.
+        if self.enabled:
+            self.ring.append((time.time(), name, None, args))
+
+    def start(self, path):
+        with self.lock:
+            if self.enabled:
+                return
+            self.path = path
+            self.stats = {}
+            with open(path, 'w'):
+                pass
+            self.enabled = True
+            self.wake.clear()
+            self.thread = Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.wake.set()
+        self.thread.join()
+        self.flush()
+        self._write(self.format_summary())
+
+    def _run(self):
+        while not self.wake.is_set():
+            self.wake.wait(self.flush_interval)
+            self.flush()
+
+    def _drain(self):
+        records = []
+        ring = self.ring
+        while ring:
+            try:
+                records.append(ring.popleft())
+            except IndexError:
+                break
+        return records
+
+    def flush(self):
+        lines = []
+        for ts, name, duration, args in self._drain():
+            if duration is not None:
+                stats = self.stats.get(name)
+                if stats is None:
+                    stats = self.stats[name] = StageStats()
+                stats.add(duration)
+                lines.append('%.6f %-20s %10.3f ms\n' % (ts, name, duration * 1000))
+            else:
+                detail = ' '.join(str(arg) for arg in args)
+                lines.append('%.6f %-20s %s\n' % (ts, name, detail))
+        if lines:
+            self._write(''.join(lines))
+
+    def format_summary(self):
+        lines = ['-' * 80 + '\n']
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            lines.append('%-20s n=%-8d mean=%9.3f ms p99=%9.3f ms max=%9.3f ms\n' % (
+                name, stats.count, stats.mean() * 1000,
+                stats.percentile(99) * 1000, stats.max * 1000
+            ))
+        return ''.join(lines)
+
+    def _write(self, text):
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(text)
+
+
+tracer = Tracer()
@@ -0,0 +1,103 @@
+import time
+
+KEYFRAME_EVERY = 20
+KEYFRAME_INTERVAL = 300.0
+
+STRING_FIELDS = (u'ItemName', u'BaseItem', u'Quality')
+
+
+class StringTable:
+
+    # Item strings are sent once and referenced by index afterwards. Indices
+    # are handed out in order, so a message only has to carry the strings
+    # added since the last one and the index of the first of them.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ids = {}
+        self.added = []
+
+    def id(self, string):
+        index = self.ids.get(string)
+        if index is None:
+            index = self.ids[string] = len(self.ids)
+            self.added.append(string)
+        return index
+
+    def encode_item(self, item):
+        if item is None:
+            return None
+        encoded = dict(item)
+        for field in STRING_FIELDS:
+            encoded[field] = self.id(item[field])
+        encoded[u'Properties'] = [self.id(prop) for prop in item[u'Properties']]
+        return encoded
+
+    def take(self):
+        added = self.added
+        self.added = []
+        return len(self.ids) - len(added), added
+
+
+class UpdateStream:
+
+    def __init__(self, delta=False, keyframe_every=KEYFRAME_EVERY,
+                 keyframe_interval=KEYFRAME_INTERVAL, strings=False):
+        self.delta = delta
+        self.keyframe_every = keyframe_every
+        self.keyframe_interval = keyframe_interval
+        # String tables only apply to delta bodies; legacy snapshots stay
+        # plain for EBS builds that know nothing else.
+        self.strings = strings
+        self.table = StringTable()
+        self.reset()
+
+    def reset(self):
+        self.seq = 0
+        self.since_keyframe = None
+        self.last_keyframe = 0
+        self.table.reset()
+
+    def request_keyframe(self):
+        # The EBS lost its copy of the table along with the sequence.
+        self.since_keyframe = None
+        self.table.reset()
+
+    def _encode_strings(self, body):
+        if u'items' in body:
+            body[u'items'] = dict(
+                (slot, self.table.encode_item(item))
+                for slot, item in body[u'items'].items()
+            )
+        if u'added' in body:
+            body[u'added'] = [self.table.encode_item(item) for item in body[u'added']]
+        base, added = self.table.take()
+        # strings_base 0 tells the EBS to start a new table.
+        if added or base == 0:
+            body[u'strings_base'] = base
+            body[u'strings'] = added
+
+    def _keyframe_due(self, now):
+        return self.since_keyframe is None or \
+            self.since_keyframe >= self.keyframe_every or \
+            now - self.last_keyframe > self.keyframe_interval
+
+    def next(self, snapshot, diff=None):
+        now = time.time()
+        if not self.delta:
+            return (now, snapshot)
+
+        self.seq += 1
+        if diff is None or self._keyframe_due(now):
+            self.since_keyframe = 0
+            self.last_keyframe = now
+            body = {u'seq': self.seq, u'keyframe': True, u'items': snapshot}
+        else:
+            self.since_keyframe += 1
+            body = {u'seq': self.seq, u'keyframe': False}
+            body.update(diff.to_dict())
+        if self.strings:
+            self._encode_strings(body)
+        return (now, body)
@@ -1,26 +1,41 @@
 from signals import SignalRegistry
-from threading import Thread, Lock
+from threading import Thread
 from ebs import EBSConnection
-from item_state import InventoryComparator
+from item_state import InventoryComparator, load_channels
+from runtime import EventLoop
+from log_sink import LogSink, LOG_LINES
+from metrics import MetricsServer, MetricsReporter, METRICS_ADDRESS
+from history import record_history
 import pygubu
 import Tkinter
 import time
 
+# Run the EBS connection and item reading on one event loop thread instead
+# of a thread per subsystem.
+EVENT_LOOP = False
+LOG_DRAIN_INTERVAL = 100
+# Serve Prometheus metrics on METRICS_ADDRESS and summarize them to the log.
+METRICS = False
+# Set to a file name to keep a gear history there (see history.py).
+HISTORY_PATH = None
+
 
 class MainWindow(pygubu.TkApplication):
 
     def _init_after(self):
         self.registry = SignalRegistry()
-        self.registry.register('log', self.log_message)
+        # Log messages come from every thread; only the Tk thread touches
+        # the widget, a batch at a time.
+        self.log_sink = LogSink()
+        self.registry.register('log', self.log_sink.put)
         self.registry.register('ebs connecting', self.on_connecting)
         self.registry.register('ebs connected', self.on_connected)
+        self.registry.register('ebs reconnecting', self.on_reconnecting)
         self.registry.register('logged in', self.on_logged_in)
         self.registry.register('logged in', self.save_if_remember)
         self.registry.register('ws thread join', self.on_disconnected)
         self.registry.register('ws thread return', self.on_disconnected)
 
-        self.logging_lock = Lock()
-
         self.registry.emit('log', 'Welcome to D2ID!', False)
         self.registry.emit(
             'log',
@@ -37,8 +52,30 @@ class MainWindow(pygubu.TkApplication):
         except:
             pass
 
-        self.ebs = EBSConnection(self.registry)
-        self.comparator = InventoryComparator(self.registry)
+        channels = load_channels(registry=self.registry)
+        if channels:
+            self.registry.emit(
+                'log', 'Reading items for channels: ' +
+                ', '.join(channel for channel, transport in channels)
+            )
+        self.runtime = EventLoop().start() if EVENT_LOOP else None
+        self.ebs = EBSConnection(
+            self.registry,
+            channels=channels and [channel for channel, transport in channels],
+            runtime=self.runtime
+        )
+        self.comparator = InventoryComparator(
+            self.registry, channels=channels, runtime=self.runtime
+        )
+        if HISTORY_PATH:
+            record_history(
+                self.registry, HISTORY_PATH,
+                channels and [channel for channel, transport in channels]
+            )
+        if METRICS:
+            self.metrics_server = MetricsServer(METRICS_ADDRESS).start()
+            self.metrics_reporter = MetricsReporter(self.registry).start()
+        self.drain_log()
 
     def _create_ui(self):
         builder = pygubu.Builder()
@@ -109,6 +146,11 @@ class MainWindow(pygubu.TkApplication):
             state=Tkinter.NORMAL, text='Disconnect', command=self.disconnect
         )
 
+    def on_reconnecting(self, delay):
+        self.elements['button_connect'].config(
+            state=Tkinter.NORMAL, text='Reconnecting...', command=self.disconnect
+        )
+
     def on_logged_in(self):
         self.registry.emit('start diff loop')
 
@@ -121,14 +163,25 @@ class MainWindow(pygubu.TkApplication):
         self.registry.emit('stop diff loop')
         self.registry.emit('ebs disconnect')
 
-    def log_message(self, message, leading_newline=True):
-        with self.logging_lock:
-            timestamp = time.strftime('\n' * leading_newline + '[%H:%M:%S] ')
-            self.elements['message_log'].config(state=Tkinter.NORMAL)
-            self.elements['message_log'].insert(Tkinter.END, timestamp, 'ts')
-            self.elements['message_log'].insert(Tkinter.END, message)
-            self.elements['message_log'].config(state=Tkinter.DISABLED)
-            self.elements['message_log'].see(Tkinter.END)
+    def drain_log(self):
+        lines = self.log_sink.drain()
+        if lines:
+            chunks = []
+            for ts, message, leading_newline in lines:
+                timestamp = time.strftime(
+                    '\n' * leading_newline + '[%H:%M:%S] ', time.localtime(ts)
+                )
+                chunks.extend((timestamp, 'ts', message, ()))
+            message_log = self.elements['message_log']
+            message_log.config(state=Tkinter.NORMAL)
+            message_log.insert(Tkinter.END, *chunks)
+            # Keep only the newest LOG_LINES lines over long streams.
+            excess = int(message_log.index('end-1c').split('.')[0]) - LOG_LINES
+            if excess > 0:
+                message_log.delete('1.0', '%d.0' % (excess + 1))
+            message_log.config(state=Tkinter.DISABLED)
+            message_log.see(Tkinter.END)
+        self.master.after(LOG_DRAIN_INTERVAL, self.drain_log)
 
     def save_if_remember(self):
         if self.window_vars['remember'].get():
@@ -13,6 +13,8 @@ namespace DiabloInterface
         public bool CreateFiles { get; set; }
         public bool DoAutosplit { get; set; }
         public bool CheckUpdates { get; set; } = true;
+        public string ItemServerPipeName { get; set; } = "DiabloInterfaceItems";
+        public bool ItemServerSnapshots { get; set; }
         public Keys AutosplitHotkey { get; set; } = Keys.None;
         public List<AutoSplit> Autosplits { get; set; } = new List<AutoSplit>();
         public List<int> Runes { get; set; } = new List<int>();
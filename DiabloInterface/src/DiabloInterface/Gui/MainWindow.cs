@@ -14,7 +14,6 @@ namespace DiabloInterface.Gui
 {
     public partial class MainWindow : Form
     {
-        private const string ItemServerPipeName = "DiabloInterfaceItems";
         private const string WindowTitleFormat = "Diablo Interface v{0}"; // {0} => Application.ProductVersion
 
         public ApplicationSettings Settings { get; private set; }
@@ -230,7 +229,7 @@ namespace DiabloInterface.Gui
             {
                 var memoryTable = GetVersionMemoryTable(Settings.D2Version);
                 dataReader = new D2DataReader(this, memoryTable);
-                itemServer = new ItemServer(dataReader, ItemServerPipeName);
+                itemServer = new ItemServer(dataReader, Settings.ItemServerPipeName, Settings.ItemServerSnapshots);
             }
 
             if (dataReaderThread == null)
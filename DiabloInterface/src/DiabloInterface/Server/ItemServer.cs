@@ -2,6 +2,7 @@
 using DiabloInterface.Logging;
 using System;
 using System.Collections.Generic;
+using System.Diagnostics;
 using System.IO;
 using System.IO.Pipes;
 using System.Text;
@@ -11,11 +12,54 @@ namespace DiabloInterface.Server
 {
     class ItemServer
     {
+        const int RequestTimeout = 1000;
+        const int IdleTimeout = 5000;
+        const int SnapshotInterval = 100;
+        // The generation only follows which items are where, not their
+        // properties (sockets, charges), so the snapshot is also rewritten
+        // this often to pick those up, like the client's full refresh.
+        const int SnapshotRefreshInterval = 5000;
+
+        class ClientConnection
+        {
+            readonly Stopwatch stopwatch = Stopwatch.StartNew();
+            volatile bool busy;
+
+            public ClientConnection(NamedPipeServerStream pipe)
+            {
+                Pipe = pipe;
+            }
+
+            public NamedPipeServerStream Pipe { get; private set; }
+
+            public void BeginRequest()
+            {
+                busy = true;
+                stopwatch.Restart();
+            }
+
+            public void EndRequest()
+            {
+                busy = false;
+                stopwatch.Restart();
+            }
+
+            public bool TimedOut(int requestTimeout, int idleTimeout)
+            {
+                return stopwatch.ElapsedMilliseconds > (busy ? requestTimeout : idleTimeout);
+            }
+        }
+
         string pipeName;
         Thread listenThread;
+        Thread snapshotThread;
         D2DataReader dataReader;
 
-        public ItemServer(D2DataReader dataReader, string pipeName)
+        object generationLock = new object();
+        int generation;
+        int equipmentFingerprint;
+
+        public ItemServer(D2DataReader dataReader, string pipeName, bool publishSnapshots = false)
         {
             this.dataReader = dataReader;
             this.pipeName = pipeName;
@@ -23,6 +67,13 @@ namespace DiabloInterface.Server
             listenThread = new Thread(new ThreadStart(ServerListen));
             listenThread.IsBackground = true;
             listenThread.Start();
+
+            if (publishSnapshots)
+            {
+                snapshotThread = new Thread(new ThreadStart(PublishSnapshots));
+                snapshotThread.IsBackground = true;
+                snapshotThread.Start();
+            }
         }
 
         public void Stop()
@@ -32,6 +83,59 @@ namespace DiabloInterface.Server
                 listenThread.Abort();
                 listenThread = null;
             }
+            if (snapshotThread != null)
+            {
+                snapshotThread.Abort();
+                snapshotThread = null;
+            }
+        }
+
+        // Keeps a shared memory copy of the equipped items, named like the
+        // pipe, current to within SnapshotInterval. Items are rebuilt when
+        // the generation moves and every SnapshotRefreshInterval.
+        void PublishSnapshots()
+        {
+            SnapshotWriter writer = null;
+            int published = -1;
+            var sinceWrite = Stopwatch.StartNew();
+            try
+            {
+                writer = new SnapshotWriter(pipeName);
+                while (true)
+                {
+                    try
+                    {
+                        int current = UpdateGeneration();
+                        if (current != published || sinceWrite.ElapsedMilliseconds >= SnapshotRefreshInterval)
+                        {
+                            writer.Write(current, ReadItems(GetItemLocations(new QueryRequest { EquipmentSlot = "all" })));
+                            published = current;
+                            sinceWrite.Restart();
+                        }
+                        writer.Beat();
+                    }
+                    catch (ThreadAbortException)
+                    {
+                        throw;
+                    }
+                    catch (Exception e)
+                    {
+                        Logger.Instance.WriteLine("Item snapshot error: {0}", e.Message);
+                    }
+                    Thread.Sleep(SnapshotInterval);
+                }
+            }
+            catch (ThreadAbortException)
+            {
+            }
+            catch (Exception e)
+            {
+                Logger.Instance.WriteLine("Item snapshots disabled: {0}", e.Message);
+            }
+            finally
+            {
+                if (writer != null) writer.Dispose();
+            }
         }
 
         void ServerListen()
@@ -51,13 +155,21 @@ namespace DiabloInterface.Server
                         PipeOptions.Asynchronous,
                         1024, 1024, ps);
                     pipe.WaitForConnection();
+                    var connection = new ClientConnection(pipe);
                     Thread clientConnectionHandler = new Thread(new ParameterizedThreadStart(HandleClientConnection)) { IsBackground = true };
-                    clientConnectionHandler.Start(pipe);
-                    if (!clientConnectionHandler.Join(1000))
+                    clientConnectionHandler.Start(connection);
+
+                    // Clients may keep the pipe open and send several requests, so only
+                    // give up on a connection that stalls mid-request or sits idle.
+                    while (!clientConnectionHandler.Join(100))
                     {
-                        clientConnectionHandler.Abort();
-                        Console.WriteLine("Connection handler timeout reached");
-                        Logger.Instance.WriteLine("Client connection handler timed out in item server thread...");
+                        if (connection.TimedOut(RequestTimeout, IdleTimeout))
+                        {
+                            clientConnectionHandler.Abort();
+                            Console.WriteLine("Connection handler timeout reached");
+                            Logger.Instance.WriteLine("Client connection handler timed out in item server thread...");
+                            break;
+                        }
                     }
                     pipe.Close();
                 }
@@ -81,79 +193,165 @@ namespace DiabloInterface.Server
             }
         }
 
-        void HandleClientConnection(Object pipeObject)
+        void HandleClientConnection(Object connectionObject)
         {
             try
             {
-                NamedPipeServerStream pipe = (NamedPipeServerStream)pipeObject;
+                ClientConnection connection = (ClientConnection)connectionObject;
+                NamedPipeServerStream pipe = connection.Pipe;
                 var reader = new JsonStreamReader(pipe, Encoding.UTF8);
-                var request = reader.ReadJson<QueryRequest>();
-
-                QueryResponse response = new QueryResponse();
-                var equipmentLocations = GetItemLocations(request);
+                var writer = new JsonStreamWriter(pipe, Encoding.UTF8);
 
-                dataReader.ItemSlotAction(equipmentLocations, (itemReader, item) =>
+                while (pipe.IsConnected)
                 {
-                    ItemQuality quality = itemReader.GetItemQuality(item);
-                    string color = null;
-                    switch (quality)
-                    {
-                        case ItemQuality.Low:
-                        case ItemQuality.Normal:
-                        case ItemQuality.Superior:
-                            color = "WHITE";
-                            break;
-                        case ItemQuality.Magic:
-                            color = "BLUE";
-                            break;
-                        case ItemQuality.Rare:
-                            color = "YELLOW";
-                            break;
-                        case ItemQuality.Crafted:
-                        case ItemQuality.Tempered:
-                            color = "ORANGE";
-                            break;
-                        case ItemQuality.Unique:
-                            color = "GOLD";
-                            break;
-                        case ItemQuality.Set:
-                            color = "GREEN";
-                            break;
-                    }
-
-                    ItemResponse data = new ItemResponse();
-                    data.ItemName = itemReader.GetFullItemName(item);
-                    data.BaseItem = itemReader.GetGrammaticalName(itemReader.GetItemName(item), out string grammerCase);
-                    data.Quality = color;
-                    data.Properties = itemReader.GetMagicalStrings(item);
-                    data.Location = itemReader.GetItemData(item)?.BodyLoc ?? BodyLocation.None;
-                    response.Items.Add(data);
-                });
-
-                response.IsValid = equipmentLocations.Count > 0;
-                response.Success = response.Items.Count > 0;
-                var writer = new JsonStreamWriter(pipe, Encoding.UTF8);
-                writer.WriteJson(response);
-                writer.Flush();
+                    var request = reader.ReadJson<QueryRequest>();
+                    connection.BeginRequest();
+                    writer.WriteJson(HandleRequest(request));
+                    writer.Flush();
+                    connection.EndRequest();
+                }
+            }
+            catch (EndOfStreamException)
+            {
+                // Client closed its end of the pipe.
             }
             catch (Exception e)
             {
                 Console.WriteLine(e.Message);
                 Logger.Instance.WriteLine("exception caught in HandleClientConnection:");
                 Logger.Instance.WriteLine(e.Message);
-                return;
+            }
+        }
+
+        QueryResponse HandleRequest(QueryRequest request)
+        {
+            if (request != null && request.Resource == "generation")
+                return HandleGenerationRequest();
+
+            return ReadItems(GetItemLocations(request));
+        }
+
+        QueryResponse ReadItems(List<BodyLocation> equipmentLocations)
+        {
+            QueryResponse response = new QueryResponse();
+            dataReader.ItemSlotAction(equipmentLocations, (itemReader, item) =>
+            {
+                ItemQuality quality = itemReader.GetItemQuality(item);
+                string color = null;
+                switch (quality)
+                {
+                    case ItemQuality.Low:
+                    case ItemQuality.Normal:
+                    case ItemQuality.Superior:
+                        color = "WHITE";
+                        break;
+                    case ItemQuality.Magic:
+                        color = "BLUE";
+                        break;
+                    case ItemQuality.Rare:
+                        color = "YELLOW";
+                        break;
+                    case ItemQuality.Crafted:
+                    case ItemQuality.Tempered:
+                        color = "ORANGE";
+                        break;
+                    case ItemQuality.Unique:
+                        color = "GOLD";
+                        break;
+                    case ItemQuality.Set:
+                        color = "GREEN";
+                        break;
+                }
+
+                ItemResponse data = new ItemResponse();
+                data.ItemName = itemReader.GetFullItemName(item);
+                data.BaseItem = itemReader.GetGrammaticalName(itemReader.GetItemName(item), out string grammerCase);
+                data.Quality = color;
+                data.Properties = itemReader.GetMagicalStrings(item);
+                data.Location = itemReader.GetItemData(item)?.BodyLoc ?? BodyLocation.None;
+                response.Items.Add(data);
+            });
+
+            response.IsValid = equipmentLocations.Count > 0;
+            response.Success = response.Items.Count > 0;
+            return response;
+        }
+
+        // Cheap change check: fingerprints the equipped item units without
+        // building item strings and bumps the generation when it differs, so
+        // clients only need to fetch full items when the generation moves.
+        QueryResponse HandleGenerationRequest()
+        {
+            QueryResponse response = new QueryResponse();
+            response.Generation = UpdateGeneration();
+            response.IsValid = true;
+            response.Success = true;
+            return response;
+        }
+
+        int UpdateGeneration()
+        {
+            var locations = GetItemLocations(new QueryRequest { EquipmentSlot = "all" });
+            // Items are filed by location and folded in location order, so the
+            // result does not depend on inventory order but does change when
+            // two items trade places (rings, weapon and shield).
+            var slots = new int[(int)BodyLocation.SecondaryRight + 1];
+            dataReader.ItemSlotAction(locations, (itemReader, item) =>
+            {
+                int location = (int)(itemReader.GetItemData(item)?.BodyLoc ?? BodyLocation.None);
+                if (location < slots.Length)
+                    slots[location] = slots[location] * 397 + item.GUID * 31 + item.eClass;
+            });
+            int fingerprint = 17;
+            foreach (int slot in slots)
+                fingerprint = fingerprint * 31 + slot;
+
+            lock (generationLock)
+            {
+                if (fingerprint != equipmentFingerprint)
+                {
+                    equipmentFingerprint = fingerprint;
+                    generation++;
+                }
+                return generation;
             }
         }
 
         List<BodyLocation> GetItemLocations(QueryRequest request)
         {
             List<BodyLocation> locations = new List<BodyLocation>();
-            if (string.IsNullOrEmpty(request.EquipmentSlot))
+            if (request == null)
                 return locations;
 
-            var name = request.EquipmentSlot.ToLowerInvariant();
+            if (!string.IsNullOrEmpty(request.EquipmentSlot))
+                AddSlotLocations(locations, request.EquipmentSlot);
+
+            // Batched requests name several slots so a full equipment
+            // snapshot only costs a single round trip.
+            if (request.EquipmentSlots != null)
+            {
+                foreach (var slot in request.EquipmentSlots)
+                {
+                    if (!string.IsNullOrEmpty(slot))
+                        AddSlotLocations(locations, slot);
+                }
+            }
+
+            return locations;
+        }
+
+        void AddSlotLocations(List<BodyLocation> locations, string slot)
+        {
+            var name = slot.ToLowerInvariant();
             switch (name)
             {
+                case "all":
+                    foreach (BodyLocation location in Enum.GetValues(typeof(BodyLocation)))
+                    {
+                        if (location != BodyLocation.None)
+                            locations.Add(location);
+                    }
+                    break;
                 case "helm":
                 case "head":
                     locations.Add(BodyLocation.Head);
@@ -204,8 +402,6 @@ namespace DiabloInterface.Server
                     break;
                 default: break;
             }
-
-            return locations;
         }
     }
 }
@@ -1,7 +1,11 @@
-﻿namespace DiabloInterface.Server
+﻿using System.Collections.Generic;
+
+namespace DiabloInterface.Server
 {
     class QueryRequest
     {
+        public string Resource { get; set; }
         public string EquipmentSlot { get; set; }
+        public List<string> EquipmentSlots { get; set; }
     }
 }
@@ -21,6 +21,7 @@ namespace DiabloInterface.Server
     {
         public bool IsValid { get; set; }
         public bool Success { get; set; }
+        public int Generation { get; set; }
         public List<ItemResponse> Items { get; set; }
 
         public QueryResponse()
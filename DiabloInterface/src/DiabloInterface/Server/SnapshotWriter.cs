@@ -0,0 +1,89 @@
+﻿using Newtonsoft.Json;
+using System;
+using System.IO.MemoryMappedFiles;
+using System.Text;
+using System.Threading;
+
+namespace DiabloInterface.Server
+{
+    // Publishes the equipped items to a named shared memory region so clients
+    // can read them without a pipe round trip. The layout is read by the
+    // D2ID client's snapshot.py and must stay in step with it:
+    //
+    //   0  8 bytes  magic "D2IDSNP1"
+    //   8  uint32   layout version
+    //  12  uint32   sequence, odd while a write is in progress
+    //  16  int32    generation, as returned by the "generation" resource
+    //  20  uint32   payload length
+    //  24  uint32   heartbeat, bumped on every check so clients can tell
+    //               a live writer from a region left behind by one
+    //  28  4 bytes  reserved
+    //  32  payload  UTF-8 JSON, the same response as an "all" item query
+    class SnapshotWriter : IDisposable
+    {
+        public const int RegionSize = 65536;
+
+        const int LayoutVersion = 1;
+        const int SequenceOffset = 12;
+        const int GenerationOffset = 16;
+        const int LengthOffset = 20;
+        const int HeartbeatOffset = 24;
+        const int HeaderSize = 32;
+
+        static readonly byte[] Magic = Encoding.ASCII.GetBytes("D2IDSNP1");
+
+        MemoryMappedFile file;
+        MemoryMappedViewAccessor view;
+        uint sequence;
+        uint heartbeat;
+
+        public SnapshotWriter(string name)
+        {
+            // CreateOrOpen, so a client that mapped the name first (and found
+            // no magic yet) sees the snapshots once they start.
+            file = MemoryMappedFile.CreateOrOpen(name, RegionSize);
+            view = file.CreateViewAccessor();
+            sequence = view.ReadUInt32(SequenceOffset);
+            if ((sequence & 1) != 0)
+                sequence++;
+        }
+
+        public void Write(int generation, QueryResponse response)
+        {
+            var payload = Encoding.UTF8.GetBytes(JsonConvert.SerializeObject(response));
+            if (payload.Length > RegionSize - HeaderSize)
+                throw new InvalidOperationException("Item snapshot does not fit the shared memory region.");
+
+            // Seqlock: readers retry if the sequence was odd or moved while
+            // they copied the payload.
+            view.Write(SequenceOffset, ++sequence);
+            Thread.MemoryBarrier();
+            view.WriteArray(HeaderSize, payload, 0, payload.Length);
+            view.Write(GenerationOffset, generation);
+            view.Write(LengthOffset, (uint)payload.Length);
+            view.WriteArray(0, Magic, 0, Magic.Length);
+            view.Write(8, (uint)LayoutVersion);
+            Thread.MemoryBarrier();
+            view.Write(SequenceOffset, ++sequence);
+        }
+
+        public void Beat()
+        {
+            view.Write(HeartbeatOffset, ++heartbeat);
+        }
+
+        public void Dispose()
+        {
+            if (view != null)
+            {
+                view.Dispose();
+                view = null;
+            }
+            if (file != null)
+            {
+                file.Dispose();
+                file = null;
+            }
+        }
+    }
+}